@@ -34,6 +34,7 @@ def cut_ranges(data,fast, a,ranges,abx_abbr,parameters):
         return data
 
     if (float(data[2]) < float(range[0])) | (float(data[2]) == float(range[0])):       #if outside lower range, change to lower range
+        new=range[0]
         if float(range[0])>1:
             new=range[0].split('.')[0]
         data[2] = new
@@ -43,6 +44,7 @@ def cut_ranges(data,fast, a,ranges,abx_abbr,parameters):
 
 
     if float(data[2]) > float(range[1]):      #if outside higher range, change to higher range
+        new=range[1]
         if float(range[1])>1:
             new=range[1].split('.')[0]
 
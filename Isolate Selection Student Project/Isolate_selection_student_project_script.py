@@ -7,10 +7,44 @@ import pandas as pd
 import json
 import numpy as np
 import itertools
-from read_cib import get_data, rank_system
+import os
+import time
+from read_cib import parse_datasets, cut_datasets, get_parsed_data
+from cib_cache import read_sheet, sheet_header, iter_sheet_blocks, file_hash
+from delta_ingest import (
+    revision_key,
+    revision_path,
+    row_ids,
+    row_hashes,
+    save_revision,
+    load_revision,
+    latest_revision,
+)
+from mic_arrays import (
+    build_mic_arrays,
+    rank_arrays,
+    pack_bits,
+    set_bit,
+    popcount,
+    MIC_DTYPE,
+    SIR_CODES,
+    SCALE_CODES,
+)
+from input_loading import load_inputs
+from profiling import profiled, count
+import profiling
 
 # Neccessary files:
 # read_cib.py
+# mic_arrays.py
+# cib_cache.py
+# table_store.py
+# delta_ingest.py
+# input_loading.py
+# selection_output.py (only for "Binary output", uses the Visualisation folder)
+# profiling.py
+# project_paths.py (puts the Visualisation folder on the import path, see add_project_folders)
+# spread_selection.py (only for "Selection mode": "Spread score", uses the Visualisation folder and abx_ranges.json)
 # parameters_settings.py (change parameters here)
 # market_prio.json
 # ranges.json
@@ -35,26 +69,86 @@ from read_cib import get_data, rank_system
 # --> See file "parameters_settings.json"
 
 
-def species_fill(
-    chosen_isolates, available_data, tempdata, parameters, isos_req, errors, pat
-):
+def build_pathogen_index(parameters, market_prio=None):
+
+    # Pathogen metadata from the parameters, built once and used for every lookup
+    # groups: {group: {"Subspecies": [...], "Overall": n, "Fastidious": f, "Priority": p}}
+    # pathogens: {pathogen: {"Group": group, "Fastidious": f, "Target": n, "Priority": p}}
+    # group order: groups in market priority order (order of isolate selection)
+
+    groups = {}
+    pathogens = {}
+    for group, v in parameters["Isolates per species"].items():
+        if not isinstance(v, dict):  # "Fill group"
+            continue
+        groups[group] = {
+            "Subspecies": [k for k in v.keys() if k not in ("Overall", "Fastidious")],
+            "Overall": v.get("Overall"),
+            "Fastidious": v.get("Fastidious"),
+            "Priority": None,
+        }
+
+    group_order = []
+    if market_prio is not None:
+        group_order = list(
+            dict.fromkeys(
+                itertools.chain.from_iterable(
+                    [market_prio[v].keys() for v, k in market_prio.items()]
+                )
+            )
+        )
+        for prio, prio_groups in market_prio.items():
+            for group in prio_groups:
+                if group in groups and groups[group]["Priority"] is None:
+                    groups[group]["Priority"] = prio
+
+    for group, v in groups.items():
+        for pat in v["Subspecies"]:
+            pathogens.setdefault(
+                pat,
+                {
+                    "Group": group,
+                    "Fastidious": v["Fastidious"],
+                    "Target": parameters["Isolates per species"][group][pat],
+                    "Priority": v["Priority"],
+                },
+            )
+
+    return {"groups": groups, "pathogens": pathogens, "group order": group_order}
+
+
+def fastidious_state(pathogen_index, pat):
+
+    # Fastidious state of a pathogen in the CIB
+    # Pathogens not named in the parameters are matched by name the same way as before (first group with a key containing it)
+    if pat in pathogen_index["pathogens"]:
+        return pathogen_index["pathogens"][pat]["Fastidious"]
+    for group, v in pathogen_index["groups"].items():
+        for k in v["Subspecies"] + ["Overall", "Fastidious"]:
+            if pat in k:
+                return v["Fastidious"]
+    return None
+
+
+@profiled("species_fill")
+def species_fill(chosen_isolates, available, index, parameters, isos_req, errors, pat):
 
     if parameters["Lower limit"][0]:
         diff = parameters["Lower limit"][1] - len(chosen_isolates)
         if diff < 0:
             chosen_isolates = chosen_isolates[: parameters["Lower limit"][1]]
-            return [chosen_isolates, available_data, tempdata, errors]
+            return [chosen_isolates, available, errors]
         if (
             diff < isos_req
         ):  # example: isos_req=5 but we are 2 isolates away from limit --> only choose 2
             isos_req = diff
 
-    chosen_data = tempdata[:isos_req]
-    chosen_isolates = pd.concat([chosen_isolates, chosen_data])
-    tempdata = tempdata[-tempdata["Isolate"].isin(list(chosen_data["Isolate"]))]
-    available_data = available_data[
-        -available_data["Isolate"].isin(list(chosen_data["Isolate"]))
-    ]
+    # best available isolates of this species
+    pat_rows = index["pathogen rows"].get(pat, np.array([], dtype=int))
+    chosen_data = pat_rows[available[pat_rows]][:isos_req]
+    count("species_fill", len(pat_rows), len(chosen_data))
+    chosen_isolates = chosen_isolates + list(chosen_data)
+    available[chosen_data] = False
 
     if len(chosen_data) != isos_req:
         errors = pd.concat(
@@ -69,7 +163,7 @@ def species_fill(
             ]
         )
 
-    return [chosen_isolates, available_data, tempdata, errors]
+    return [chosen_isolates, available, errors]
 
 
 def get_bugdrug_fill(parameters):
@@ -103,18 +197,130 @@ def get_bugdrug_fill(parameters):
     return bugdrug_fill
 
 
-def bugdrug_fill(
-    chosen_isolates, available_data, tempdata, parameters, abx, errors, pat
-):
+def scenario_matches(arr, a, s):
+
+    # Find isolates that match bugdrug fill scenario s for antibiotic a, arr = mic_arrays[a]
+    # If both US and EU, it is enough that one of the values match
+
+    # s:
+    # [SIR, scale, POS/NEG]
+
+    # covered: rule for counting isolates that are already chosen
+    # pickable: rule for choosing new isolates
+
+    SIR_labels = SIR_CODES + [None]  # last label is for unknown (code -1)
+    SCALE_labels = SCALE_CODES + [None]
+
+    if a == "D-test":
+        POS = [label == "POS" for label in SCALE_labels]
+        if s[2] != "":
+            covered_SCALE = [p == s[2] for p in POS]
+        else:  # req=''
+            covered_SCALE = [label in ("NEG", "POS") for label in SCALE_labels]
+        pickable_SCALE = [(p == s[2]) | (s[2] == "") for p in POS]
+        covered_SIR = pickable_SIR = [True for label in SIR_labels]
+
+    else:
+        covered_SIR = [s[0] in str(label) for label in SIR_labels]
+        covered_SCALE = [s[1] in str(label) for label in SCALE_labels]
+        pickable_SIR = [label == s[0] for label in SIR_labels]
+        if a == "Gentamicin":
+            pickable_SCALE = [True for label in SCALE_labels]
+        else:
+            pickable_SCALE = [label == s[1] for label in SCALE_labels]
+
+    entry = arr["REGION"] != 0
+    covered = (
+        np.array(covered_SIR)[arr["SIR"]]
+        & np.array(covered_SCALE)[arr["SCALE"]]
+        & entry
+    ).any(axis=1)
+    pickable = (
+        np.array(pickable_SIR)[arr["SIR"]]
+        & np.array(pickable_SCALE)[arr["SCALE"]]
+        & entry
+    ).any(axis=1)
+
+    return [covered, pickable]
+
+
+@profiled("build_selection_index")
+def build_selection_index(available_data, mic_arrays, abx, parameters):
+
+    # Precompute everything the isolate selection looks up, once per ranked dataset
+    # Isolates are rows in mic_arrays, the index of available_data
+    # order: all rows sorted by Q-rank (order of available_data)
+    # pathogen rows: rows of every pathogen, sorted by Q-rank
+    # valid: rows with a value for an antibiotic
+    # covered: rows that count as covering a bugdrug scenario, per (antibiotic, scenario)
+    # covered bits: the same per (pathogen, antibiotic) as bitsets over the rows of the pathogen, one bitset per scenario
+    # pathogen position: position of every row in the pathogen rows of its pathogen
+    # candidates: rows that can be chosen for a bugdrug scenario, per (pathogen, antibiotic, scenario), sorted by Q-rank
+
+    order = available_data.index.to_numpy()
+    pathogen = available_data["Pathogen"].to_numpy()
+
+    n = len(next(iter(mic_arrays.values())))
+    pathogen_by_row = np.full(n, None, dtype=object)
+    pathogen_by_row[order] = pathogen
+
+    if parameters["Bugdrug fill"][0]:
+        scenarios = get_bugdrug_fill(parameters)
+    else:
+        scenarios = []
+
+    index = {
+        "order": order,
+        "pathogen": pathogen,
+        "pathogen by row": pathogen_by_row,
+        "pathogen rows": {pat: order[pathogen == pat] for pat in pd.unique(pathogen)},
+        "pathogen position": np.zeros(n, dtype=int),
+        "scenarios": scenarios,
+        "valid": {},
+        "covered": {},
+        "covered bits": {},
+        "candidates": {},
+    }
+    for pat, pat_rows in index["pathogen rows"].items():
+        index["pathogen position"][pat_rows] = np.arange(len(pat_rows))
+
+    for a in abx:
+        arr = mic_arrays[a]
+        index["valid"][a] = arr["SIR"][:, 0] != 0
+        for i, s in enumerate(scenarios):
+            [covered, pickable] = scenario_matches(arr, a, s)
+            index["covered"][(a, i)] = covered
+            pickable = pickable & index["valid"][a]
+            for pat, pat_rows in index["pathogen rows"].items():
+                index["candidates"][(pat, a, i)] = pat_rows[pickable[pat_rows]]
+
+        for pat, pat_rows in index["pathogen rows"].items():
+            covered = np.zeros((len(scenarios), len(pat_rows)), dtype=bool)
+            for i in range(len(scenarios)):
+                covered[i] = index["covered"][(a, i)][pat_rows]
+            index["covered bits"][(pat, a)] = pack_bits(covered)
+
+    return index
+
+
+@profiled("bugdrug_fill")
+def bugdrug_fill(chosen_isolates, available, index, parameters, abx, errors, pat):
 
     if not parameters["Bugdrug fill"][0]:
-        return [chosen_isolates, available_data, errors]
+        return [chosen_isolates, available, errors]
 
     else:
 
         isos_req = parameters["Bugdrug fill"][1]
 
-        scenarios = get_bugdrug_fill(parameters)
+        pat_rows = index["pathogen rows"].get(pat, np.array([], dtype=int))
+        position = index["pathogen position"]
+
+        # chosen isolates of this species as a bitset over the rows of the species
+        chosen_rows = np.array(chosen_isolates, dtype=int)
+        chosen_bits = pack_bits(np.zeros(len(pat_rows), dtype=bool))
+        for row in chosen_rows[index["pathogen by row"][chosen_rows] == pat]:
+            set_bit(chosen_bits, position[row])
 
         for a in abx:
 
@@ -124,114 +330,35 @@ def bugdrug_fill(
                 diff = parameters["Lower limit"][1] - len(chosen_isolates)
                 if diff < 0:
                     chosen_isolates = chosen_isolates[: parameters["Lower limit"][1]]
-                    return [chosen_isolates, available_data, errors]
+                    return [chosen_isolates, available, errors]
                 if (
                     diff < remain
                 ):  # example: remain=5 but we are 2 isolates away from limit --> only choose 2
                     remain = diff
 
             # valid data
-            isos_valid = [
-                row["Isolate"]
-                for index, row in tempdata.iterrows()
-                if list(row[a].values())[0][0] != 0
-            ]
-            tempdata_valid = tempdata[tempdata["Isolate"].isin(isos_valid)]
-
-            bugdrug_chosen = chosen_isolates[chosen_isolates["Pathogen"] == pat][[a]]
-
-            for index, row in bugdrug_chosen.iterrows():
-                vals = list(row.values[0].values())
-                for s in scenarios:
-                    # if both US and EU
-                    for v in vals:
-
-                        if a == "D-test":
-                            POS = True if v[3] == "POS" else False
-
-                            if s[2] != "":
-                                if s[2] == POS:  # each can be true or false
-                                    remain -= 1
-                                    break
-                            else:  # req=''
-                                if (v[3] == "NEG") | (v[3] == "POS"):  # check if valid
-                                    remain -= 1
-                                    break
-
-                        # If both EU and US values, only one counts
-                        elif (s[0] in str(v[0])) & (
-                            s[1] in str(v[3])
-                        ):  # SIR and on-scale information
-                            remain -= 1
-                            break
-
-            for s in scenarios:  # try to find only best scenario first
-                for index, row in tempdata_valid.iterrows():
-                    # if both US and EU
-                    for k, v in row[a].items():
-                        if remain < 1:
-                            break
-
-                        SIR = v[0]
-                        scale = v[3]
-
-                        # v:
-                        # [SIR, sign, mic, scale]
-                        # [SIR, sign, mic, POS/NEG]
-
-                        # s:
-                        # [SIR, scale, POS/NEG]
-
-                        if a == "D-test":
-
-                            POS = True if v[3] == "POS" else False
-
-                            if POS == s[2]:
-                                pass  # OK - choose isolates
-                            elif s[2] == "":
-                                pass  # OK - choose isolates
-                            else:
-                                continue  # Not OK - move on
-
-                            chosen_data = pd.DataFrame(row.to_frame().T)
-                            chosen_isolates = pd.concat([chosen_isolates, chosen_data])
-                            tempdata = tempdata[
-                                -tempdata["Isolate"].isin(list(chosen_data["Isolate"]))
-                            ]
-                            available_data = available_data[
-                                -available_data["Isolate"].isin(
-                                    list(chosen_data["Isolate"])
-                                )
-                            ]
-                            remain -= 1
-
-                        else:
-                            if SIR == s[0]:
-
-                                if a == "Gentamicin":
-                                    pass  # OK - choose isolates
-
-                                else:
-                                    if scale == s[1]:
-                                        pass  # OK - choose isolates
-                                    else:
-                                        continue  # Not OK - move on
-
-                                chosen_data = pd.DataFrame(row.to_frame().T)
-                                chosen_isolates = pd.concat(
-                                    [chosen_isolates, chosen_data]
-                                )
-                                tempdata = tempdata[
-                                    -tempdata["Isolate"].isin(
-                                        list(chosen_data["Isolate"])
-                                    )
-                                ]
-                                available_data = available_data[
-                                    -available_data["Isolate"].isin(
-                                        list(chosen_data["Isolate"])
-                                    )
-                                ]
-                                remain -= 1
+            isos_valid = pat_rows[index["valid"][a][pat_rows] & available[pat_rows]]
+            count("bugdrug_fill", len(pat_rows), len(isos_valid))
+
+            # chosen isolates of this species already covering a scenario
+            # each scenario an isolate covers counts
+            covered_bits = index["covered bits"].get(
+                (pat, a), pack_bits(np.zeros((len(index["scenarios"]), 0), dtype=bool))
+            )
+            remain -= int(popcount(covered_bits & chosen_bits).sum())
+
+            for i in range(len(covered_bits)):  # try to find only best scenario first
+                # pathogens without isolates in the CIB have no candidates
+                for row in index["candidates"].get((pat, a, i), pat_rows):
+                    if remain < 1:
+                        break
+                    if not available[row]:  # already chosen
+                        continue
+
+                    chosen_isolates.append(row)
+                    available[row] = False
+                    set_bit(chosen_bits, position[row])
+                    remain -= 1
 
             chosen = isos_req - remain
             if remain > 0:
@@ -250,30 +377,29 @@ def bugdrug_fill(
                         ]
                     )
 
-    return [chosen_isolates, available_data, errors]
+    return [chosen_isolates, available, errors]
 
 
+@profiled("group_fill")
 def group_fill(
-    chosen_isolates, available_data, parameters, pat_group, errors, subspecies
+    chosen_isolates, available, index, parameters, pat_group, errors, subspecies
 ):
 
     # fill with other pats from same group if necessary
     if not parameters["Isolates per species"]["Fill group"]:
-        return [chosen_isolates, available_data, errors]
+        return [chosen_isolates, available, errors]
 
     else:
 
-        overall = parameters["Isolates per species"][pat_group]["Overall"]
+        overall = index["groups"][pat_group]["Overall"]
 
         # all subspecies within that group
-        tempdata = available_data[
-            available_data["Pathogen"].isin(
-                list(parameters["Isolates per species"][pat_group].keys())[:-2]
-            )
-        ]
+        group_pats = index["groups"][pat_group]["Subspecies"]
+        group_rows = index["order"][np.isin(index["pathogen"], group_pats)]
 
-        remain = overall - len(
-            chosen_isolates[chosen_isolates["Pathogen"].isin(subspecies)]
+        chosen_rows = np.array(chosen_isolates, dtype=int)
+        remain = overall - int(
+            np.isin(index["pathogen by row"][chosen_rows], subspecies).sum()
         )
 
         if remain < 0:
@@ -283,17 +409,16 @@ def group_fill(
             diff = parameters["Lower limit"][1] - len(chosen_isolates)
             if diff < 0:
                 chosen_isolates = chosen_isolates[: parameters["Lower limit"][1]]
-                return [chosen_isolates, available_data, errors]
+                return [chosen_isolates, available, errors]
             if (
                 diff < remain
             ):  # example: remain=5 but we are 2 isolates away from limit --> only choose 2
                 remain = diff
 
-        chosen_data = tempdata[:remain]
-        chosen_isolates = pd.concat([chosen_isolates, chosen_data])
-        available_data = available_data[
-            -available_data["Isolate"].isin(list(chosen_data["Isolate"]))
-        ]
+        chosen_data = group_rows[available[group_rows]][:remain]
+        count("group_fill", len(index["order"]), len(chosen_data))
+        chosen_isolates = chosen_isolates + list(chosen_data)
+        available[chosen_data] = False
 
         # chosen before + chosen now
         chosen_tot = (overall - remain) + len(chosen_data)
@@ -311,28 +436,29 @@ def group_fill(
                 ]
             )
 
-    return [chosen_isolates, available_data, errors]
+    return [chosen_isolates, available, errors]
 
 
-def isolate_selection(available_data, parameters, errors, pats_groups, abx):
+@profiled("isolate_selection")
+def isolate_selection(index, available, parameters, errors, pats_groups, abx):
 
-    chosen_isolates = pd.DataFrame()
+    # chosen isolates as rows in mic_arrays, in the order they were chosen
+    # available[row] is False once an isolate is chosen
+    chosen_isolates = []
 
     for pat_group in pats_groups:
 
-        subspecies = list(parameters["Isolates per species"][pat_group].keys())[:-2]
+        subspecies = index["groups"][pat_group]["Subspecies"]
 
         for pat in subspecies:
 
-            isos_req = parameters["Isolates per species"][pat_group][pat]
-
-            tempdata = available_data[available_data["Pathogen"] == pat]
+            isos_req = index["pathogens"][pat]["Target"]
 
             # Species fill
-            [chosen_isolates, available_data, tempdata, errors] = species_fill(
+            [chosen_isolates, available, errors] = species_fill(
                 chosen_isolates,
-                available_data,
-                tempdata,
+                available,
+                index,
                 parameters,
                 isos_req,
                 errors,
@@ -340,19 +466,20 @@ def isolate_selection(available_data, parameters, errors, pats_groups, abx):
             )
 
             # Bugdrug fill
-            [chosen_isolates, available_data, errors] = bugdrug_fill(
-                chosen_isolates, available_data, tempdata, parameters, abx, errors, pat
+            [chosen_isolates, available, errors] = bugdrug_fill(
+                chosen_isolates, available, index, parameters, abx, errors, pat
             )
 
         # After going through all subspecies, fill for entire pathogen group
-        [chosen_isolates, available_data, errors] = group_fill(
-            chosen_isolates, available_data, parameters, pat_group, errors, subspecies
+        [chosen_isolates, available, errors] = group_fill(
+            chosen_isolates, available, index, parameters, pat_group, errors, subspecies
         )
 
-    return [available_data, chosen_isolates, errors]
+    return [available, chosen_isolates, errors]
 
 
-def upper_fill(available_data, parameters, chosen_isolates):
+@profiled("upper_fill")
+def upper_fill(available, index, parameters, chosen_isolates):
 
     # Fill to this limit if not already surpassed
 
@@ -362,115 +489,538 @@ def upper_fill(available_data, parameters, chosen_isolates):
         if diff < 0:
             diff = 0
     else:
-        return [available_data, chosen_isolates]
+        return [available, chosen_isolates]
 
-    chosen_data = available_data[:diff]
-    chosen_isolates = pd.concat([chosen_isolates, chosen_data])
-    available_data = available_data[
-        -available_data["Isolate"].isin(list(chosen_data["Isolate"]))
-    ]
+    order = index["order"]
+    chosen_data = order[available[order]][:diff]
+    count("upper_fill", len(order), len(chosen_data))
+    chosen_isolates = chosen_isolates + list(chosen_data)
+    available[chosen_data] = False
 
-    return [available_data, chosen_isolates]
+    return [available, chosen_isolates]
 
 
-def iso_sel_setup(available_data, abx, parameters, market_prio):
+@profiled("iso_sel_setup")
+def iso_sel_setup(
+    available_data, abx, parameters, market_prio, mic_arrays, spread_data=None
+):
 
     # Setup
+    # available_data: ranked dataset sorted by Q-rank, index = row in mic_arrays
+    # spread_data: [matrix EU, abx_ranges], only needed for "Selection mode": "Spread score"
+    spread = parameters.get("Selection mode", "Q-rank") == "Spread score"
+    if spread and spread_data is None:
+        raise ValueError(
+            "Selection mode 'Spread score' needs spread_data: [matrix EU, abx_ranges]"
+        )
+    # "Spread time budget" counts from here, building the index and the spread tracker included
+    deadline = time.perf_counter() + parameters.get("Spread time budget", 2)
     errors = pd.DataFrame()
-    pat_prio = list(
-        dict.fromkeys(
-            itertools.chain.from_iterable(
-                [market_prio[v].keys() for v, k in market_prio.items()]
+    pathogen_index = build_pathogen_index(parameters, market_prio)
+    pat_prio = pathogen_index["group order"]
+
+    index = build_selection_index(available_data, mic_arrays, abx, parameters)
+    index.update(pathogen_index)
+    available = np.zeros(len(index["pathogen by row"]), dtype=bool)
+    available[index["order"]] = True
+
+    # Q-rank selection, with "Selection mode": "Spread score" also the result if the time budget
+    # has passed before the spread search starts or if it has the higher panel score,
+    # so the spread score selection never scores lower than the Q-rank selection
+    [qrank_available, chosen_isolates, errors] = isolate_selection(
+        index, available.copy(), parameters, errors, pat_prio, abx
+    )
+    [_, chosen_isolates] = upper_fill(
+        qrank_available, index, parameters, chosen_isolates
+    )
+
+    if spread and time.perf_counter() <= deadline:
+        # imported here, a Q-rank run does not need the Visualisation folder
+        from spread_selection import spread_selection, spread_tracker
+
+        names = available_data["Isolate"].sort_index().to_numpy()
+        tracker = spread_tracker(spread_data[0], names, spread_data[1])
+        if time.perf_counter() <= deadline:
+            [_, spread_isolates, spread_errors] = spread_selection(
+                index,
+                available,
+                parameters,
+                pd.DataFrame(),
+                pat_prio,
+                names,
+                tracker,
+                deadline,
             )
+            qrank_score = tracker.panel_score_after(
+                add=names[chosen_isolates], remove=names[spread_isolates]
+            )
+            if tracker.panel_score() >= qrank_score:
+                [chosen_isolates, errors] = [spread_isolates, spread_errors]
+
+    chosen_isolates = available_data.loc[chosen_isolates]
+    count("iso_sel_setup", len(available_data), len(chosen_isolates))
+
+    return [chosen_isolates, errors]
+
+
+@profiled("read_datasets")
+def read_datasets(CIB, parameters):
+
+    # get data from CIB and relevant antibiotics
+    # sheets are read from the CIB cache after the first run (see cib_cache.py)
+    sheets = {}
+    for d in parameters["Datasets"]:
+        try:
+            sheets[f"matrix {d}"] = read_sheet(CIB, f"matrix {d}")
+        except ValueError:
+            sheets[f"matrix {d}"] = None
+
+    return select_datasets(sheets, parameters)
+
+
+def select_datasets(sheets, parameters):
+
+    # Datasets and relevant antibiotics from already read sheets, {sheet name: DataFrame or None if not in the CIB}
+    data = {}
+    abx = list()
+    for d in parameters["Datasets"]:
+        tempdata = sheets.get(f"matrix {d}")
+        if tempdata is None:
+            print(f"Data region '{d}' not valid, try 'US' or 'EU'")
+            continue
+        data[f"{d}"] = tempdata
+        abx += list(data[f"{d}"].columns[3:])
+        data_default = data[f"{d}"]
+    if not data:
+        raise ValueError(
+            f"None of the datasets {parameters['Datasets']} found in the CIB"
         )
+    abx = list(np.unique(abx))
+
+    return [data, abx, data_default]
+
+
+def dataset_isolates(data_default, parameters):
+
+    # Isolates until the last rows, [isolate, pathogen, fastidious state] of every isolate
+    # fastidious state from the pathogen index
+    pathogen_index = build_pathogen_index(parameters)
+    last_rows = data_default.iloc[:, 1].map(type) == float
+    n = int(last_rows.to_numpy().argmax()) if last_rows.any() else len(data_default)
+    fast = {
+        pat: fastidious_state(pathogen_index, pat)
+        for pat in pd.unique(data_default.iloc[:n, 1])
+    }
+
+    return [
+        [iso, pat, fast[pat]]
+        for iso, pat in zip(data_default.iloc[:n, 0], data_default.iloc[:n, 1])
+    ]
+
+
+@profiled("mic_cells")
+def mic_cells(parsed_frames, abx, n):
+
+    # Parsed values of every isolate as dicts, e.g. {'EU': [SIR, SIGN, VALUE, SCALE]}, n per antibiotic
+    # One Python object per cell, so only built with "MIC cells": true (the selection only uses the arrays)
+    parsed = {}
+    for t, p in parsed_frames.items():
+        parsed[t] = {a: frame.values.tolist() for a, frame in p.items()}
+
+    return {a: [get_parsed_data(parsed, j, a) for j in range(n)] for a in abx}
+
+
+@profiled("rank_parsed")
+def rank_parsed(isolates, parsed_frames, abx, parameters):
+
+    # Ranked dataset and arrays from parsed datasets (parse_datasets)
+    # Columns Isolate, Pathogen, Fastidious, the MIC cells of every antibiotic ("MIC cells") and Q-rank
+    mic_arrays = build_mic_arrays(parsed_frames, abx)
+
+    # Build new dataset once, add rank for all isolates and sort isolates by rank
+    comb_dataset = pd.DataFrame(isolates, columns=["Isolate", "Pathogen", "Fastidious"])
+    if parameters.get("MIC cells", True):
+        for a, cells in mic_cells(parsed_frames, abx, len(isolates)).items():
+            comb_dataset[a] = cells
+    comb_dataset["Q-rank"] = rank_arrays(mic_arrays, parameters["Point system"])
+    sorted_dataset = comb_dataset.sort_values("Q-rank", ascending=False)
+
+    return [sorted_dataset, mic_arrays]
+
+
+@profiled("rank_dataset")
+def rank_dataset(data, data_default, abx, parameters, ranges, abx_abbr):
+
+    # Parse and rank all isolates
+    # Returns the dataset sorted by Q-rank and the parsed values as arrays (see mic_arrays.py)
+    # The index of the sorted dataset is the row of the isolate in the arrays
+
+    isolates = dataset_isolates(data_default, parameters)
+
+    # Parse every dataset, all isolates and antibiotics at once
+    # optionally in parallel with "Ingest workers" processes
+    fast_states = [fast for iso, pat, fast in isolates]
+    parsed_frames = parse_datasets(
+        data,
+        abx,
+        ranges,
+        abx_abbr,
+        fast_states,
+        parameters,
+        parameters.get("Ingest workers", 1),
     )
 
-    [available_data, chosen_isolates, errors] = isolate_selection(
-        available_data, parameters, errors, pat_prio, abx
+    [sorted_dataset, mic_arrays] = rank_parsed(isolates, parsed_frames, abx, parameters)
+    count("rank_dataset", len(data_default), len(sorted_dataset))
+
+    return [sorted_dataset, mic_arrays]
+
+
+@profiled("rank_dataset_kits")
+def rank_dataset_kits(data, data_default, abx, parameters, ranges, abx_abbr, kits):
+
+    # rank_dataset for several kit software versions at once
+    # The CIB is parsed once without cutting to reportable ranges, then cut and ranked for every kit
+    # Returns {kit: [sorted_dataset, mic_arrays]}, same as rank_dataset with that "Kit Software Version"
+
+    isolates = dataset_isolates(data_default, parameters)
+    fast_states = [fast for iso, pat, fast in isolates]
+    parsed_frames = parse_datasets(
+        data,
+        abx,
+        ranges,
+        abx_abbr,
+        fast_states,
+        dict(parameters, **{"Kit Software Version": None}),
+        parameters.get("Ingest workers", 1),
     )
-    [available_data, chosen_isolates] = upper_fill(
-        available_data, parameters, chosen_isolates
+
+    ranked = {}
+    for kit in kits:
+        kit_frames = cut_datasets(parsed_frames, ranges, abx_abbr, fast_states, kit)
+        ranked[kit] = rank_parsed(isolates, kit_frames, abx, parameters)
+        count("rank_dataset_kits", len(data_default), len(ranked[kit][0]))
+
+    return ranked
+
+
+@profiled("rank_dataset_delta")
+def rank_dataset_delta(CIB, data, data_default, abx, parameters, ranges, abx_abbr):
+
+    # Same result as rank_dataset, but only isolates that are new or changed since the latest stored revision
+    # of the CIB are parsed and ranked, rows are matched by Isolate ID (see delta_ingest.py)
+    # The result is stored as a new revision
+    key = revision_key(parameters, ranges, abx_abbr)
+    path = revision_path(CIB, key, file_hash(CIB))
+    revision = load_revision(path)
+    if revision is not None and revision["point system"] == parameters["Point system"]:
+        return [revision["sorted_dataset"], revision["mic_arrays"]]
+    if revision is None:
+        revision = latest_revision(CIB, key)
+
+    # Isolates until the last rows, same as in rank_dataset
+    last_rows = data_default.iloc[:, 1].map(type) == float
+    n = int(last_rows.to_numpy().argmax()) if last_rows.any() else len(data_default)
+    rows = {
+        t: d.iloc[:n].reset_index(drop=True).reindex(range(n)) for t, d in data.items()
+    }
+    ids = row_ids(data_default.iloc[:n, 0])
+    hashes = row_hashes(rows, n)
+
+    # unchanged rows: same Isolate ID and cell contents as in the stored revision
+    old_rows = np.full(n, -1)
+    if revision is not None and revision["abx"] == abx:
+        old_index = {row_id: j for j, row_id in enumerate(revision["ids"])}
+        old_rows = np.array([old_index.get(row_id, -1) for row_id in ids], dtype=int)
+    same = old_rows >= 0
+    if same.any():
+        same[same] = revision["hashes"][old_rows[same]] == hashes[same]
+    changed = np.flatnonzero(~same)
+    count("rank_dataset_delta", n, len(changed))
+
+    if len(changed) == n:
+        [sorted_dataset, mic_arrays] = rank_dataset(
+            data, data_default, abx, parameters, ranges, abx_abbr
+        )
+    else:
+        # stored rows, in the order of the new CIB
+        unchanged = np.flatnonzero(same)
+        old_dataset = revision["sorted_dataset"].sort_index()
+        frames = [old_dataset.iloc[old_rows[unchanged]].set_axis(unchanged)]
+        mic_arrays = {}
+        for a in abx:
+            arr = np.zeros((n, 2), dtype=MIC_DTYPE)
+            arr[unchanged] = revision["mic_arrays"][a][old_rows[unchanged]]
+            mic_arrays[a] = arr
+
+        # parse and rank the changed rows only
+        if len(changed):
+            default = [t for t, d in data.items() if d is data_default][0]
+            changed_data = {
+                t: d.iloc[changed].reset_index(drop=True) for t, d in rows.items()
+            }
+            [changed_dataset, changed_arrays] = rank_dataset(
+                changed_data,
+                changed_data[default],
+                abx,
+                parameters,
+                ranges,
+                abx_abbr,
+            )
+            frames.append(changed_dataset.sort_index().set_axis(changed))
+            for a in abx:
+                mic_arrays[a][changed] = changed_arrays[a]
+        comb_dataset = pd.concat(frames).sort_index()
+
+        # stored Q-ranks are only valid with the same point system
+        if revision["point system"] != parameters["Point system"]:
+            comb_dataset["Q-rank"] = rank_arrays(mic_arrays, parameters["Point system"])
+        sorted_dataset = comb_dataset.sort_values("Q-rank", ascending=False)
+
+    save_revision(
+        path,
+        {
+            "ids": ids,
+            "hashes": hashes,
+            "abx": abx,
+            "point system": parameters["Point system"],
+            "sorted_dataset": sorted_dataset,
+            "mic_arrays": mic_arrays,
+        },
     )
 
-    return [chosen_isolates, errors]
+    return [sorted_dataset, mic_arrays]
 
 
-def main(CIB, parameters, ranges, abx_abbr, market_prio):
+@profiled("rank_dataset_streaming")
+def rank_dataset_streaming(CIB, parameters, ranges, abx_abbr, block_size):
 
-    # Setup
-    inputdata = pd.ExcelFile(CIB)
-    comb_dataset = pd.DataFrame()
-    parameters = json.load(open(parameters))
-    ranges = json.load(open(ranges))
-    abx_abbr = json.load(open(abx_abbr))
-    market_prio = json.load(open(market_prio))
+    # Same as read_datasets + rank_dataset, but the CIB is read and parsed block_size isolates at a time
+    # Only the compact result is kept: Isolate, Pathogen, Fastidious and Q-rank per isolate and the mic arrays,
+    # so memory does not grow with the size of the matrix sheets
+    # Returns [sorted_dataset, mic_arrays, abx]
 
-    # get data from CIB and relevant antibiotics
-    data = {}
+    datasets = []
     abx = list()
     for d in parameters["Datasets"]:
         try:
-            tempdata = pd.read_excel(inputdata, f"matrix {d}")
-            data[f"{d}"] = tempdata
+            header = sheet_header(CIB, f"matrix {d}")
         except ValueError:
             print(f"Data region '{d}' not valid, try 'US' or 'EU'")
             continue
-        abx += list(data[f"{d}"].columns[3:])
-        data_default = data[f"{d}"]
+        datasets.append(d)
+        abx += header[3:]
     abx = list(np.unique(abx))
 
-    # Go through data and put into new df with rank
-    for j in range(0, len(data_default)):
+    pathogen_index = build_pathogen_index(parameters)
+    fast = {}
+
+    ranked_columns = {"Isolate": [], "Pathogen": [], "Fastidious": []}
+    ranks = []
+    mic_blocks = {a: [] for a in abx}
 
-        # last rows
-        if type(data_default.iloc[j, 1]) == float:
+    # blocks of all datasets side by side, rows of the last dataset decide which isolates there are
+    blocks = itertools.zip_longest(
+        *[iter_sheet_blocks(CIB, f"matrix {d}", block_size) for d in datasets]
+    )
+    for block in blocks:
+        data = dict(zip(datasets, block))
+        data_default = data[datasets[-1]]
+        if data_default is None:
             break
+        data = {t: pd.DataFrame() if d is None else d for t, d in data.items()}
 
-        res = {}
-        iso = data_default.iloc[j, 0]
-        pat = data_default.iloc[j, 1]
-        res["Isolate"] = iso
-        res["Pathogen"] = pat
+        for pat in pd.unique(data_default.iloc[:, 1]):
+            if pat not in fast:
+                fast[pat] = fastidious_state(pathogen_index, pat)
+        fast_states = [fast[pat] for pat in data_default.iloc[:, 1]]
 
-        # get fastidious state
-        isolates_per_species = dict(
-            list(parameters["Isolates per species"].items())[1:]
-        )
-        break_loop = False
-        for k1, v1 in isolates_per_species.items():
-            for k2, v2 in v1.items():
-                if pat in k2:
-                    fast = isolates_per_species[k1]["Fastidious"]
-                    break_loop = True
-                    break
-            if break_loop:
-                break
-        res["Fastidious"] = fast
-
-        # iterate through every abx(column) for that isolate
+        ranked_columns["Isolate"] += list(data_default.iloc[:, 0])
+        ranked_columns["Pathogen"] += list(data_default.iloc[:, 1])
+        ranked_columns["Fastidious"] += fast_states
+
+        # parse, cut to range and rank this block only
+        parsed = parse_datasets(data, abx, ranges, abx_abbr, fast_states, parameters)
+        block_arrays = build_mic_arrays(parsed, abx)
+        ranks.append(rank_arrays(block_arrays, parameters["Point system"]))
         for a in abx:
+            mic_blocks[a].append(block_arrays[a])
 
-            # Get data
-            final_data = get_data(data, j, a, ranges, abx_abbr, fast, parameters)
-            res[a] = final_data
+    mic_arrays = {a: np.concatenate(mic_blocks[a]) for a in abx}
 
-        # Add rank for that isolate
-        res = rank_system(res, parameters["Point system"])
+    comb_dataset = pd.DataFrame(ranked_columns)
+    comb_dataset["Q-rank"] = np.concatenate(ranks)
+    sorted_dataset = comb_dataset.sort_values("Q-rank", ascending=False)
+    count("rank_dataset_streaming", len(sorted_dataset), len(sorted_dataset))
 
-        # Add isolate to new dataset
-        comb_dataset = pd.concat([comb_dataset, pd.DataFrame([res])])
+    return [sorted_dataset, mic_arrays, abx]
 
-    # sort isolates by rank
-    sorted_dataset = comb_dataset.sort_values("Q-rank", ascending=False)
 
-    # isolate selection
-    [chosen_isolates, errors] = iso_sel_setup(
-        sorted_dataset, abx, parameters, market_prio
-    )
+@profiled("rescore_dataset")
+def rescore_dataset(sorted_dataset, mic_arrays, point_system):
+
+    # Rank the dataset again with another point system, without parsing the CIB again
+    # Same order as if the dataset was ranked from scratch with that point system
+    comb_dataset = sorted_dataset.sort_index()
+    comb_dataset["Q-rank"] = rank_arrays(mic_arrays, point_system)[comb_dataset.index]
+
+    return comb_dataset.sort_values("Q-rank", ascending=False)
+
+
+# Concentration ranges used by the spread score (same file as the visualisation)
+ABX_RANGES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "Visualisation", "abx_ranges.json"
+)
+
+
+def main(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges=ABX_RANGES):
+
+    # Setup: input files and CIB sheets are loaded concurrently (see input_loading.py)
+    inputs = load_inputs(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges)
+    parameters = inputs["parameters"]
+    ranges = inputs["ranges"]
+    abx_abbr = inputs["abx abbr"]
+    market_prio = inputs["market prio"]
+
+    # "Profile": write wall time, calls, peak memory and rows per stage to this file
+    if parameters.get("Profile"):
+        profiling.enable()
+
+    try:
+        # "Ingest block size": read the CIB in blocks of isolates instead of whole sheets (for very large CIBs)
+        block_size = parameters.get("Ingest block size", 0)
+        if block_size:
+            data = {}
+            [sorted_dataset, mic_arrays, abx] = rank_dataset_streaming(
+                CIB, parameters, ranges, abx_abbr, block_size
+            )
+        else:
+            [data, abx, data_default] = select_datasets(inputs["sheets"], parameters)
+
+            # "Delta ingest": only parse isolates that changed since the last ranked revision of the CIB
+            if parameters.get("Delta ingest", False):
+                [sorted_dataset, mic_arrays] = rank_dataset_delta(
+                    CIB, data, data_default, abx, parameters, ranges, abx_abbr
+                )
+            else:
+                [sorted_dataset, mic_arrays] = rank_dataset(
+                    data, data_default, abx, parameters, ranges, abx_abbr
+                )
+
+        # spread score selection scores the panel on matrix EU, like the visualisation
+        spread_data = None
+        if parameters.get("Selection mode", "Q-rank") == "Spread score":
+            spread_data = [inputs["sheets"]["matrix EU"], inputs["abx ranges"]]
+
+        # isolate selection
+        [chosen_isolates, errors] = iso_sel_setup(
+            sorted_dataset, abx, parameters, market_prio, mic_arrays, spread_data
+        )
+
+        # "Binary output": write ranked dataset, chosen isolates and MIC values for the visualisation
+        if parameters.get("Binary output"):
+            # imported here, only the binary output needs the Visualisation folder
+            from selection_output import write_selection_output
+
+            write_selection_output(
+                parameters["Binary output"],
+                CIB,
+                sorted_dataset,
+                mic_arrays,
+                abx,
+                chosen_isolates,
+                inputs["sheets"].get("matrix EU"),
+                inputs["CIB hash"],
+            )
+
+        if parameters.get("Profile"):
+            profiling.write(parameters["Profile"])
+    finally:
+        # also when a stage raises, so a long-running process does not keep tracing
+        if parameters.get("Profile"):
+            profiling.disable()
 
     return [chosen_isolates, sorted_dataset, errors]
 
 
+def main_kits(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges=ABX_RANGES):
+
+    # Same as main for several kit software versions, to compare kits without a full run per kit
+    # Kits from "Compare kits" in the parameters, all kits in ranges.json if empty
+    # The CIB is read and parsed once, cutting to reportable ranges, ranking and selection are done per kit
+    # "Binary output" and "Profile" work as in main, "Ingest block size" and "Delta ingest" raise ValueError
+    # Returns {kit: [chosen_isolates, sorted_dataset, errors]}
+    inputs = load_inputs(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges)
+    parameters = inputs["parameters"]
+    kits = parameters.get("Compare kits") or list(inputs["ranges"])
+
+    # every kit is ranked from one parse of the whole CIB, reading in blocks or per revision would parse it per kit
+    for option in ["Ingest block size", "Delta ingest"]:
+        if parameters.get(option):
+            raise ValueError(f"'{option}' can not be used with 'Compare kits'")
+
+    # "Profile": as in main, over all kits
+    if parameters.get("Profile"):
+        profiling.enable()
+
+    try:
+        [data, abx, data_default] = select_datasets(inputs["sheets"], parameters)
+        ranked = rank_dataset_kits(
+            data,
+            data_default,
+            abx,
+            parameters,
+            inputs["ranges"],
+            inputs["abx abbr"],
+            kits,
+        )
+
+        spread_data = None
+        if parameters.get("Selection mode", "Q-rank") == "Spread score":
+            spread_data = [inputs["sheets"]["matrix EU"], inputs["abx ranges"]]
+
+        results = {}
+        for kit, [sorted_dataset, mic_arrays] in ranked.items():
+            [chosen_isolates, errors] = iso_sel_setup(
+                sorted_dataset,
+                abx,
+                dict(parameters, **{"Kit Software Version": kit}),
+                inputs["market prio"],
+                mic_arrays,
+                spread_data,
+            )
+            results[kit] = [chosen_isolates, sorted_dataset, errors]
+
+            # "Binary output": one folder per kit in the given folder, named like the kit's output files
+            if parameters.get("Binary output"):
+                from selection_output import write_selection_output
+
+                write_selection_output(
+                    os.path.join(parameters["Binary output"], kit_file_name(kit)),
+                    CIB,
+                    sorted_dataset,
+                    mic_arrays,
+                    abx,
+                    chosen_isolates,
+                    inputs["sheets"].get("matrix EU"),
+                    inputs["CIB hash"],
+                )
+
+        if parameters.get("Profile"):
+            profiling.write(parameters["Profile"])
+    finally:
+        if parameters.get("Profile"):
+            profiling.disable()
+
+    return results
+
+
+def kit_file_name(kit):
+
+    # Kit software version as part of a file or folder name
+    return "".join(c if c.isalnum() or c in "+-." else "_" for c in kit)
+
+
 if __name__ == "__main__":
 
     # Input
@@ -480,10 +1030,21 @@ if __name__ == "__main__":
     abx_abbr = "Isolate Selection Student Project/abx_abbr.json"
     market_prio = "Isolate Selection Student Project\market_prio.json"
 
-    [chosen_isolates, sorted_dataset, errors] = main(
-        CIB, parameters, ranges, abx_abbr, market_prio
-    )
+    with open(parameters) as f:
+        compare_kits = json.load(f).get("Compare kits", [])
+
+    # "Compare kits": one selection per kit, output files named after the kit
+    if compare_kits:
+        results = main_kits(CIB, parameters, ranges, abx_abbr, market_prio)
+    else:
+        results = {None: main(CIB, parameters, ranges, abx_abbr, market_prio)}
 
     # Output
-    chosen_isolates["Isolate"].to_csv("Chosen_isolates_list.csv", index=False)
-    np.savetxt("Errors.txt", errors.to_numpy(), fmt="%s")
+    for kit, [chosen_isolates, sorted_dataset, errors] in results.items():
+        suffix = ""
+        if kit is not None:
+            suffix = "_" + kit_file_name(kit)
+        chosen_isolates["Isolate"].to_csv(
+            f"Chosen_isolates_list{suffix}.csv", index=False
+        )
+        np.savetxt(f"Errors{suffix}.txt", errors.to_numpy(), fmt="%s")
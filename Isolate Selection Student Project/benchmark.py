@@ -0,0 +1,213 @@
+# Benchmark of the isolate selection pipeline on synthetic CIB data
+
+# Generates matrix EU/US sheets with the same cell grammar as the CIB ("R >16 ", "S <=0.25 ", "Missing BP =1 ", "nip", ...)
+# and times every stage separately:
+# ingest (parse_datasets), MIC arrays, MIC cells (the dicts in the ranked dataset, timed with "MIC cells" on),
+# ranking (rank_arrays), species_fill, bugdrug_fill, group_fill, upper_fill,
+# spread scoring (calc_mic_spread_dict) and plot-frame building (create_plot_df)
+
+# Every run appends one json line per size to the output file, so throughput can be followed over time
+
+# Usage: python benchmark.py [--sizes 1000 10000 100000] [--output benchmark_results.jsonl] [--seed 0]
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+import Isolate_selection_student_project_script as selection
+
+import project_paths
+
+project_paths.add_project_folders()
+from spread_score_calc import calc_mic_spread_dict
+from data_extraction_functions import extract_chosen_isolates, extract_mic_frame
+from plotly_testpanel_vis import create_plot_df
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ANTIBIOTICS = list(
+    json.load(open(os.path.join(HERE, "..", "Visualisation", "abx_ranges.json")))
+)
+
+
+def synthetic_cells(rng, n):
+
+    # n random cells with the CIB grammar
+    # Same mix as the real CIB: mostly 'nip', some 'Missing BP', rest S/I/R with a MIC value
+    mic = 2.0 ** rng.integers(-9, 10, n)
+    SIR = rng.choice(["S", "I", "R"], n, p=[0.7, 0.1, 0.2])
+    sign = np.where(rng.random(n) < 0.2, np.where(SIR == "R", ">", "<="), "=")
+    sign = np.where(SIR == "I", "=", sign)
+    kind = rng.choice(
+        ["value", "nip", "Missing BP", "Missing BP value"],
+        n,
+        p=[0.45, 0.45, 0.05, 0.05],
+    )
+
+    values = pd.Series(mic).map(lambda v: f"{v:g}").to_numpy(dtype=object)
+    cells = np.where(
+        kind == "value",
+        SIR.astype(object) + " " + sign.astype(object) + values + " ",
+        np.where(
+            kind == "Missing BP value",
+            "Missing BP " + sign.astype(object) + values + " ",
+            np.where(kind == "Missing BP", "Missing BP  ", "nip"),
+        ),
+    )
+
+    return cells
+
+
+def synthetic_cib(n_isolates, parameters, seed=0):
+
+    # Synthetic {"US": matrix US, "EU": matrix EU} with n_isolates rows and the footer rows of the CIB
+    rng = np.random.default_rng(seed)
+    pathogens = [
+        pat
+        for group, v in list(parameters["Isolates per species"].items())[1:]
+        for pat in list(v.keys())[:-2]
+    ]
+
+    isolates = [f"SYN{i:07d}" for i in range(n_isolates)]
+    pathogen = rng.choice(pathogens, n_isolates)
+
+    data = {}
+    for t in ["US", "EU"]:
+        sheet = {
+            "Isolate": isolates,
+            "Pathogen": pathogen,
+            "Source RMT": ["synthetic"] * n_isolates,
+        }
+        for a in ANTIBIOTICS:
+            sheet[a] = synthetic_cells(rng, n_isolates)
+        sheet = pd.DataFrame(sheet)
+        footer = pd.DataFrame(
+            {"Isolate": ["Clinical Breakpoints", "DataSets", "Generated"]}
+        )
+        data[t] = pd.concat([sheet, footer], ignore_index=True)
+
+    return data
+
+
+@contextmanager
+def timer(timings, stage):
+
+    start = time.perf_counter()
+    yield
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+
+
+def timed(timings, stage, function):
+
+    # function that adds its run time to timings[stage]
+    def wrapper(*args, **kwargs):
+        with timer(timings, stage):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def run_benchmark(
+    n_isolates, parameters, ranges, abx_abbr, market_prio, abx_ranges, seed=0
+):
+
+    # Time every stage of the pipeline for n_isolates synthetic isolates
+    # Returns {stage: seconds}
+    # MIC cells on, so their cost shows as its own stage
+    parameters = dict(parameters, **{"MIC cells": True})
+    data = synthetic_cib(n_isolates, parameters, seed)
+    data = {t: data[t] for t in parameters["Datasets"]}
+    abx = list(np.unique(ANTIBIOTICS))
+    data_default = list(data.values())[-1]
+    matrix_EU = data["EU"] if "EU" in data else data_default
+    timings = {}
+
+    # stages are timed by wrapping the functions the selection script calls
+    stages = {
+        "parse_datasets": "ingest",
+        "build_mic_arrays": "mic arrays",
+        "mic_cells": "MIC cells",
+        "rank_arrays": "ranking",
+        "species_fill": "species_fill",
+        "bugdrug_fill": "bugdrug_fill",
+        "group_fill": "group_fill",
+        "upper_fill": "upper_fill",
+    }
+    originals = {name: getattr(selection, name) for name in stages}
+    for name, stage in stages.items():
+        setattr(selection, name, timed(timings, stage, originals[name]))
+    try:
+        with timer(timings, "rank_dataset total"):
+            [sorted_dataset, mic_arrays] = selection.rank_dataset(
+                data, data_default, abx, parameters, ranges, abx_abbr
+            )
+        with timer(timings, "iso_sel_setup total"):
+            [chosen_isolates, errors] = selection.iso_sel_setup(
+                sorted_dataset,
+                abx,
+                parameters,
+                market_prio,
+                mic_arrays,
+                [matrix_EU, abx_ranges],
+            )
+    finally:
+        for name, function in originals.items():
+            setattr(selection, name, function)
+
+    with timer(timings, "spread scoring"):
+        calc_mic_spread_dict(chosen_isolates[["Isolate"]], matrix_EU, abx_ranges)
+
+    with timer(timings, "plot frame"):
+        chosen = extract_chosen_isolates(chosen_isolates[["Isolate"]], matrix_EU)
+        antibiotics = list(chosen.columns[3:])
+        mic_frame = extract_mic_frame(chosen, antibiotics)
+        create_plot_df(antibiotics, mic_frame)
+
+    return timings
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--output", default="benchmark_results.jsonl")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    parameters = json.load(open(os.path.join(HERE, "parameters_settings.json")))
+    ranges = json.load(open(os.path.join(HERE, "ranges.json")))
+    abx_abbr = json.load(open(os.path.join(HERE, "abx_abbr.json")))
+    market_prio = json.load(open(os.path.join(HERE, "market_prio.json")))
+    abx_ranges = json.load(
+        open(os.path.join(HERE, "..", "Visualisation", "abx_ranges.json"))
+    )
+
+    run = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "seed": args.seed,
+    }
+
+    with open(args.output, "a") as f:
+        for n in args.sizes:
+            timings = run_benchmark(
+                n, parameters, ranges, abx_abbr, market_prio, abx_ranges, args.seed
+            )
+            result = dict(run, isolates=n, seconds=timings)
+            result["isolates per second"] = {
+                stage: n / seconds if seconds > 0 else None
+                for stage, seconds in timings.items()
+            }
+            f.write(json.dumps(result) + "\n")
+
+            print(f"{n} isolates")
+            for stage, seconds in timings.items():
+                print(f"  {stage:<22}{seconds:10.4f} s")
@@ -0,0 +1,177 @@
+# Cache of parsed CIB sheets, so the Excel file only has to be read once
+
+# The first time a sheet is read it is stored as a columnar table (see table_store.py) in a cache folder next to the CIB
+# The cache entry is keyed by the hash of the CIB file and the sheet name,
+# so a new or changed CIB is read from Excel again automatically
+
+# Used by the isolate selection script and the visualisation scripts
+# Ingest a CIB beforehand with: python cib_cache.py <CIB> [sheet ...]
+
+import hashlib
+import json
+import os
+import sys
+import openpyxl
+import pandas as pd
+
+from table_store import atomic_write, write_frame, read_frame
+
+CACHE_DIR = ".cib_cache"
+
+
+def file_hash(CIB):
+
+    # sha256 of the CIB file, read in blocks
+    sha = hashlib.sha256()
+    with open(CIB, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def cache_path(CIB, sheet, cache_dir=None, digest=None):
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(CIB)), CACHE_DIR)
+    if digest is None:
+        digest = file_hash(CIB)
+
+    name = os.path.splitext(os.path.basename(CIB))[0]
+    sheet_name = sheet.replace(" ", "_")
+
+    return os.path.join(cache_dir, f"{name}_{digest[:16]}_{sheet_name}")
+
+
+def write_cached_sheet(path, data):
+
+    # Sheets with cells that can not be stored without pickle are not cached, they are read from Excel every time
+    try:
+        with atomic_write(path) as tmp:
+            os.makedirs(tmp)
+            meta = write_frame(tmp, "sheet", data)
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+    except TypeError:
+        pass
+
+
+def read_cached_sheet(path):
+
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return read_frame(path, "sheet", meta)
+
+
+def read_sheets(CIB, sheets, cache_dir=None, digest=None):
+
+    # Same as pd.read_excel(CIB, sheet) for every sheet, but from cache if possible
+    # Sheets that are not cached are read from one pd.ExcelFile and added to the cache
+    # Raises ValueError if a sheet is not in the CIB, like pd.read_excel
+    # digest: file_hash of the CIB if already known
+
+    if digest is None:
+        digest = file_hash(CIB)
+    data = {}
+    missing = []
+    for sheet in sheets:
+        path = cache_path(CIB, sheet, cache_dir, digest)
+        try:
+            data[sheet] = read_cached_sheet(path)
+        except Exception:  # not cached yet or broken cache file, read from Excel
+            missing.append(sheet)
+
+    if missing:
+        inputdata = pd.ExcelFile(CIB)
+        for sheet in missing:
+            data[sheet] = pd.read_excel(inputdata, sheet)
+            path = cache_path(CIB, sheet, cache_dir, digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_cached_sheet(path, data[sheet])
+
+    return data
+
+
+def read_sheet(CIB, sheet, cache_dir=None, digest=None):
+
+    return read_sheets(CIB, [sheet], cache_dir, digest)[sheet]
+
+
+def ingest(CIB, sheets=None, cache_dir=None):
+
+    # Convert all matrix sheets (or the given sheets) of a CIB to the cache
+    if sheets is None:
+        sheets = [
+            sheet
+            for sheet in pd.ExcelFile(CIB).sheet_names
+            if sheet.startswith("matrix ")
+        ]
+
+    return read_sheets(CIB, sheets, cache_dir)
+
+
+# Streaming reader for CIB files that are too large to read at once
+# Rows are read one at a time with openpyxl in read-only mode and handed out in blocks of isolates
+
+
+def open_sheet(CIB, sheet):
+
+    # Read-only workbook and worksheet, raises ValueError if the sheet is not in the CIB, like pd.read_excel
+    workbook = openpyxl.load_workbook(CIB, read_only=True, data_only=True)
+    if sheet not in workbook.sheetnames:
+        workbook.close()
+        raise ValueError(f"Worksheet named '{sheet}' not found")
+    worksheet = workbook[sheet]
+    # some exports store a wrong sheet size, which makes read-only mode miss rows
+    worksheet.reset_dimensions()
+
+    return [workbook, worksheet]
+
+
+def sheet_header(CIB, sheet):
+
+    # Column names of a sheet (first row), without trailing empty columns
+    [workbook, worksheet] = open_sheet(CIB, sheet)
+    try:
+        header = list(next(worksheet.iter_rows(values_only=True), ()))
+    finally:
+        workbook.close()
+    while header and header[-1] is None:
+        header.pop()
+
+    return header
+
+
+def iter_sheet_blocks(CIB, sheet, block_size):
+
+    # DataFrames of up to block_size isolates, with the same columns as pd.read_excel(CIB, sheet)
+    # Stops at the last rows of the CIB (first row without a pathogen name)
+    [workbook, worksheet] = open_sheet(CIB, sheet)
+    try:
+        rows = worksheet.iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        while header and header[-1] is None:
+            header.pop()
+        n = len(header)
+
+        block = []
+        for row in rows:
+            if len(row) < 2 or not isinstance(row[1], str):
+                break
+            block.append(tuple(row[:n]) + (None,) * (n - len(row)))
+            if len(block) == block_size:
+                yield pd.DataFrame(block, columns=header)
+                block = []
+        if block:
+            yield pd.DataFrame(block, columns=header)
+    finally:
+        workbook.close()
+
+
+if __name__ == "__main__":
+
+    CIB = sys.argv[1]
+    sheets = sys.argv[2:] if len(sys.argv) > 2 else None
+
+    for sheet, data in ingest(CIB, sheets).items():
+        print(f"{sheet}: {len(data)} rows cached")
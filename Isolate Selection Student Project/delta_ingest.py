@@ -0,0 +1,135 @@
+# Stored ranked CIB revisions, for re-ingesting a new CIB revision incrementally
+
+# After a CIB has been parsed and ranked, the result is stored next to the CIB cache (cib_cache.CACHE_DIR),
+# together with the Isolate ID and a hash of the cell contents of every isolate row
+# When a new revision arrives, its rows are matched to the latest stored revision by Isolate ID
+# and only new or changed rows are parsed and ranked again (see rank_dataset_delta in the selection script)
+
+# Stored results are only reused with the same parse key (datasets, kit, species and fastidious setup)
+# and the same ranges.json, abx_abbr.json and cell parsing rules (mic_tokens.PARSE_VERSION)
+# A revision is a folder with meta.json and columnar tables (see table_store.py)
+
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from cib_cache import CACHE_DIR, file_hash
+from mic_tokens import PARSE_VERSION
+from table_store import atomic_write, write_table, read_table, write_frame, read_frame
+
+
+def parse_key(parameters):
+
+    # Parameters that change how the CIB is parsed, sets with the same key share parsed data
+    species = [
+        [group, list(v.keys()), v.get("Fastidious")]
+        for group, v in list(parameters["Isolates per species"].items())[1:]
+    ]
+    return json.dumps(
+        [parameters["Datasets"], parameters.get("Kit Software Version"), species]
+    )
+
+
+def revision_key(parameters, ranges, abx_abbr):
+
+    # Short hash of everything that decides the parsed values and the columns of the ranked dataset
+    key = [
+        parse_key(parameters),
+        parameters.get("MIC cells", True),
+        ranges,
+        abx_abbr,
+        PARSE_VERSION,
+    ]
+    key = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def revision_path(CIB, key, digest=None):
+
+    if digest is None:
+        digest = file_hash(CIB)
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(CIB)), CACHE_DIR)
+    return os.path.join(cache_dir, f"ranked_{key}_{digest[:16]}")
+
+
+def row_ids(isolates):
+
+    # Isolate ID of every row, repeated IDs are numbered so every row has its own ID
+    isolates = pd.Series(list(isolates), dtype=object)
+    return list(zip(isolates, isolates.groupby(isolates).cumcount()))
+
+
+def row_hashes(rows, n):
+
+    # Hash of the cell contents of every row, over all datasets
+    # rows: {dataset: DataFrame with n rows}, rows are compared as text so a changed cell always changes the hash
+    hashes = np.zeros(n, dtype=np.uint64)
+    for t, d in rows.items():
+        row_hash = pd.util.hash_pandas_object(d.astype(str), index=False).to_numpy()
+        hashes = hashes * np.uint64(1000003) ^ row_hash
+
+    return hashes
+
+
+def save_revision(path, revision):
+
+    # Revisions with cells that can not be stored (see table_store.cell_kind) are not saved
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    abx = revision["abx"]
+    ids = pd.DataFrame(revision["ids"], columns=["Isolate", "Number"])
+    try:
+        with atomic_write(path) as tmp:
+            os.makedirs(tmp)
+            meta = {
+                "abx": abx,
+                "point system": revision["point system"],
+                "ids": write_frame(tmp, "ids", ids),
+                "sorted_dataset": write_frame(
+                    tmp, "sorted_dataset", revision["sorted_dataset"]
+                ),
+                "hashes": write_table(tmp, "hashes", {"hashes": revision["hashes"]}),
+                "mic_arrays": write_table(
+                    tmp, "mic_arrays", {a: revision["mic_arrays"][a] for a in abx}
+                ),
+            }
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+    except TypeError:
+        pass
+
+
+def load_revision(path):
+
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        ids = read_frame(path, "ids", meta["ids"])
+        return {
+            "ids": list(zip(ids["Isolate"].tolist(), ids["Number"].tolist())),
+            "hashes": read_table(path, "hashes", meta["hashes"], None)["hashes"],
+            "abx": meta["abx"],
+            "point system": meta["point system"],
+            "sorted_dataset": read_frame(
+                path, "sorted_dataset", meta["sorted_dataset"]
+            ),
+            "mic_arrays": read_table(path, "mic_arrays", meta["mic_arrays"], None),
+        }
+    except Exception:  # missing or broken revision, parse from scratch
+        return None
+
+
+def latest_revision(CIB, key):
+
+    # Most recently stored revision with the same key, from any CIB file in the same folder
+    pattern = revision_path(CIB, key, "*" * 16).replace("*" * 16, "*")
+    paths = [path for path in glob.glob(pattern) if not path.endswith(".tmp")]
+    paths = sorted(paths, key=os.path.getmtime, reverse=True)
+    for path in paths:
+        revision = load_revision(path)
+        if revision is not None:
+            return revision
+
+    return None
@@ -0,0 +1,178 @@
+# Concurrent loading of all inputs of the isolate selection and the visualisation
+
+# All input files are read at the same time instead of one after another:
+# JSON and CSV files and the CIB sheets are each read in their own executor thread (asyncio.to_thread)
+# The parameters are read first, they decide which sheets are needed
+# The CIB file is hashed once for all sheets (see cib_cache.py)
+# Loading is then bounded by the slowest input instead of the sum of all inputs
+
+# Everything is returned as one bundle (dict), checked by validate_inputs
+
+# Reading a sheet that is not cached yet is mostly Python work (openpyxl),
+# so several uncached sheets still take about as long as reading them one after another
+
+import asyncio
+import concurrent.futures
+import json
+import pandas as pd
+
+from cib_cache import file_hash, read_sheet
+
+# parameters the selection cannot run without
+REQUIRED_PARAMETERS = [
+    "Datasets",
+    "Upper fill",
+    "Lower limit",
+    "Isolates per species",
+    "Bugdrug fill",
+    "Point system",
+]
+
+
+def load_json(path):
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def run(coroutine):
+
+    # asyncio.run, also from code that already runs an event loop (e.g. a notebook)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+async def load_sheets(CIB, sheets, digest):
+
+    # Every sheet in its own thread, sheets that are not in the CIB are None
+    async def load(sheet):
+        try:
+            return await asyncio.to_thread(read_sheet, CIB, sheet, None, digest)
+        except ValueError:
+            return None
+
+    frames = await asyncio.gather(*[load(sheet) for sheet in sheets])
+
+    return dict(zip(sheets, frames))
+
+
+def needed_sheets(parameters):
+
+    # CIB sheets the selection reads with these parameters
+    sheets = []
+    # "Ingest block size": the CIB is read in blocks later on, not as whole sheets
+    if not parameters.get("Ingest block size", 0):
+        sheets += [f"matrix {d}" for d in parameters.get("Datasets", [])]
+    # spread score selection scores the panel on matrix EU, the binary output holds its MIC values
+    if parameters.get("Selection mode", "Q-rank") == "Spread score":
+        sheets.append("matrix EU")
+    if parameters.get("Binary output"):
+        sheets.append("matrix EU")
+
+    return list(dict.fromkeys(sheets))
+
+
+def validate_inputs(bundle):
+
+    # Raises ValueError with all problems found in the loaded inputs
+    parameters = bundle["parameters"]
+    problems = [
+        f"Parameter '{key}' missing"
+        for key in REQUIRED_PARAMETERS
+        if key not in parameters
+    ]
+
+    sheets = bundle["sheets"]
+    datasets = [f"matrix {d}" for d in parameters.get("Datasets", [])]
+    if datasets and all(sheets.get(sheet) is None for sheet in datasets):
+        if not parameters.get("Ingest block size", 0):
+            problems.append(
+                f"None of the datasets {parameters['Datasets']} found in the CIB"
+            )
+    if parameters.get("Selection mode", "Q-rank") == "Spread score":
+        if sheets.get("matrix EU") is None:
+            problems.append("Spread score selection needs the sheet 'matrix EU'")
+        if bundle["abx ranges"] is None:
+            problems.append("Spread score selection needs abx_ranges.json")
+
+    if problems:
+        raise ValueError("Invalid input: " + "; ".join(problems))
+
+    # MIC values are not cut to reportable ranges for an unknown kit (see read_cib.cut_ranges)
+    kit = parameters.get("Kit Software Version")
+    if kit is not None and kit not in bundle["ranges"]:
+        print(f"Kit Software Version '{kit}' not in ranges, reportable ranges not used")
+
+    return bundle
+
+
+async def load_inputs_async(
+    CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges=None
+):
+
+    # Read the parameters and input files and the needed CIB sheets concurrently
+    # abx_ranges is only read for the spread score selection
+    digest = asyncio.create_task(asyncio.to_thread(file_hash, CIB))
+    files = asyncio.gather(
+        *[
+            asyncio.to_thread(load_json, path)
+            for path in [ranges, abx_abbr, market_prio]
+        ]
+    )
+    parameters = await asyncio.to_thread(load_json, parameters)
+
+    spread = parameters.get("Selection mode", "Q-rank") == "Spread score"
+    spread_file = None
+    if spread and abx_ranges is not None:
+        spread_file = asyncio.create_task(asyncio.to_thread(load_json, abx_ranges))
+
+    digest = await digest
+    sheets = load_sheets(CIB, needed_sheets(parameters), digest)
+    [sheets, [ranges, abx_abbr, market_prio]] = await asyncio.gather(sheets, files)
+
+    return validate_inputs(
+        {
+            "parameters": parameters,
+            "ranges": ranges,
+            "abx abbr": abx_abbr,
+            "market prio": market_prio,
+            "abx ranges": await spread_file if spread_file is not None else None,
+            "sheets": sheets,
+            "CIB hash": digest,
+        }
+    )
+
+
+def load_inputs(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges=None):
+
+    return run(
+        load_inputs_async(CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges)
+    )
+
+
+async def load_visualisation_inputs_async(chosen_isolates_list, CIB, abx_ranges=None):
+
+    # Chosen isolates list (CSV), matrix EU of the CIB and abx_ranges.json (if given), read concurrently
+    async def no_file():
+        return None
+
+    [chosen_isolates_list, matrix_EU, abx_ranges] = await asyncio.gather(
+        asyncio.to_thread(pd.read_csv, chosen_isolates_list),
+        asyncio.to_thread(read_sheet, CIB, "matrix EU"),
+        asyncio.to_thread(load_json, abx_ranges) if abx_ranges else no_file(),
+    )
+
+    return {
+        "chosen isolates list": chosen_isolates_list,
+        "matrix EU": matrix_EU,
+        "abx ranges": abx_ranges,
+    }
+
+
+def load_visualisation_inputs(chosen_isolates_list, CIB, abx_ranges=None):
+
+    return run(load_visualisation_inputs_async(chosen_isolates_list, CIB, abx_ranges))
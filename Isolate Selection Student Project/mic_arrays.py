@@ -0,0 +1,158 @@
+# Compact representation of parsed CIB data for isolate selection
+
+# One NumPy structured array per antibiotic, shape (isolates, 2)
+# Row j is the isolate in row j of the CIB (same order as parse_matrix)
+# Slot 0 holds the first value of the isolate, slot 1 the second value if US and EU differ (see comp_data)
+# Fields:
+# SIR, SIGN, SCALE: categorical codes, index into SIR_CODES, SIGN_CODES and SCALE_CODES (-1 if unknown)
+# VALUE: MIC as float32
+# REGION: bitmask, 1 = US, 2 = EU, 3 = US+EU, 0 = empty slot
+
+import numpy as np
+import pandas as pd
+
+from profiling import profiled
+
+SIR_CODES = [0, "S", "I", "R", "Missing_BP", "NS", "SDD"]
+SIGN_CODES = [0, "=", "<=", "<", ">", ">=", ""]
+SCALE_CODES = [0, "on-scale", "off-scale", "POS", "NEG", "-"]
+
+REGIONS = {"US": 1, "EU": 2, "US+EU": 3}
+
+MIC_DTYPE = np.dtype(
+    [
+        ("SIR", "i1"),
+        ("SIGN", "i1"),
+        ("VALUE", "f4"),
+        ("SCALE", "i1"),
+        ("REGION", "u1"),
+    ]
+)
+
+
+def encode(values, codes):
+
+    # Map labels to their index in codes, unknown labels get -1
+    lookup = {label: code for code, label in enumerate(codes)}
+    return pd.Series(values).map(lookup).fillna(-1).to_numpy(dtype="i1")
+
+
+def encode_frame(frame, region):
+
+    # One parse_matrix DataFrame to a structured array of length n
+    arr = np.zeros(len(frame), dtype=MIC_DTYPE)
+    arr["SIR"] = encode(frame["SIR"].to_numpy(), SIR_CODES)
+    arr["SIGN"] = encode(frame["SIGN"].to_numpy(), SIGN_CODES)
+    arr["VALUE"] = frame["VALUE"].to_numpy(dtype="f4")
+    arr["SCALE"] = encode(frame["SCALE"].to_numpy(), SCALE_CODES)
+    arr["REGION"] = region
+
+    return arr
+
+
+@profiled("build_mic_arrays")
+def build_mic_arrays(parsed, abx):
+
+    # parsed: {dataset: {antibiotic: DataFrame}} from parse_matrix
+    # If both US and EU, the datasets are compared per isolate in the same way as comp_data
+
+    mic_arrays = {}
+
+    for a in abx:
+
+        if len(parsed) == 1:
+            [(t, p)] = parsed.items()
+            n = len(p[a])
+            arr = np.zeros((n, 2), dtype=MIC_DTYPE)
+            arr[:, 0] = encode_frame(p[a], REGIONS.get(t, 0))
+            mic_arrays[a] = arr
+            continue
+
+        US, EU = parsed["US"][a], parsed["EU"][a]
+        n = len(US)
+        arr = np.zeros((n, 2), dtype=MIC_DTYPE)
+
+        same = US.eq(EU).all(axis=1).to_numpy()
+        US_empty = (US["SIR"] == 0).to_numpy()
+        EU_empty = (EU["SIR"] == 0).to_numpy()
+        both = ~same & ~US_empty & ~EU_empty
+
+        US_arr = encode_frame(US, REGIONS["US"])
+        EU_arr = encode_frame(EU, REGIONS["EU"])
+
+        # only EU valid --> EU in first slot, else US
+        only_EU = ~same & US_empty
+        arr[:, 0] = np.where(only_EU, EU_arr, US_arr)
+        arr["REGION"][same, 0] = REGIONS["US+EU"]
+
+        # both valid but diff --> EU in second slot
+        arr[both, 1] = EU_arr[both]
+
+        mic_arrays[a] = arr
+
+    return mic_arrays
+
+
+def point_table(point_system, codes):
+
+    # Points for every code of a field, last entry is for unknown labels (code -1)
+    return np.array([point_system.get(label, 0) for label in codes] + [0])
+
+
+@profiled("rank_arrays")
+def rank_arrays(mic_arrays, point_system):
+
+    # Array version of rank_system, Q-rank of every isolate
+    # Points for SIR and scale of every value are looked up in one go and summed per isolate
+    # rank_system gave points for any label, here a label without a code would silently get 0 points
+    unknown = [
+        label
+        for label in point_system
+        if label not in SIR_CODES and label not in SCALE_CODES
+    ]
+    if unknown:
+        raise ValueError(
+            f"Point system labels {unknown} are not SIR or scale labels, "
+            f"known labels: {SIR_CODES[1:] + SCALE_CODES[1:]}"
+        )
+
+    SIR_points = point_table(point_system, SIR_CODES)
+    SCALE_points = point_table(point_system, SCALE_CODES)
+
+    SIR = np.stack([arr["SIR"] for arr in mic_arrays.values()], axis=1)
+    SCALE = np.stack([arr["SCALE"] for arr in mic_arrays.values()], axis=1)
+
+    points = SIR_points[SIR] + SCALE_points[SCALE]
+
+    return points.reshape(len(points), -1).sum(axis=1)
+
+
+# Bitsets over isolates, bit i of word i // 64 is isolate i
+
+# Number of set bits in every byte, for NumPy versions without np.bitwise_count
+BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+    axis=1
+)
+
+
+def pack_bits(mask):
+
+    # Boolean array (..., n) to bitsets of 64-bit words (..., ceil(n / 64))
+    mask = np.asarray(mask, dtype=bool)
+    n = mask.shape[-1]
+    padded = np.zeros(mask.shape[:-1] + (-(-n // 64) * 64,), dtype=bool)
+    padded[..., :n] = mask
+    return np.packbits(padded, axis=-1, bitorder="little").view("<u8")
+
+
+def set_bit(bits, i):
+
+    bits[i >> 6] |= np.uint64(1) << np.uint64(i & 63)
+
+
+def popcount(bits):
+
+    # Number of set bits in the last axis
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+    return BYTE_POPCOUNT[bits.view(np.uint8)].sum(axis=-1, dtype=np.int64)
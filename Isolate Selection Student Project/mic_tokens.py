@@ -0,0 +1,104 @@
+# Interned MIC cell strings, shared by the isolate selection and the visualisation
+
+# A CIB only has a few hundred distinct cell strings ("S <=0.25 ", "R >16 ", "Missing BP =1 ", "nip", ...)
+# repeated in every sheet. Every distinct string is parsed once per process into a token,
+# and cells are mapped to token ids, so parsing costs depend on the number of distinct strings, not cells
+
+# Token fields:
+# SIR, SIGN, VALUE, valid, off-scale: selection rules (read_cib.parse_matrix), same as read_cib.extract_data
+# first word: text before the first space (D-test)
+# Vis valid, Vis SIR, MIC, on-scale, scale known: visualisation rules (parse_SIR, find_digits, get_scale)
+
+# Cells that are not strings (empty cells) get token id -1, the last row of every token table
+
+import numpy as np
+import pandas as pd
+
+TOKEN_COLUMNS = [
+    "SIR",
+    "SIGN",
+    "VALUE",
+    "valid",
+    "off-scale",
+    "first word",
+    "Vis valid",
+    "Vis SIR",
+    "MIC",
+    "on-scale",
+    "scale known",
+]
+
+# version of the cell parsing rules, part of the key of stored ranked revisions (delta_ingest.revision_key)
+PARSE_VERSION = 3
+
+# token of an empty cell, last row of every token table
+EMPTY_TOKEN = (0, 0, 0.0, False, False, np.nan, False, None, np.nan, False, False)
+
+# parsed tokens of every cell string seen so far
+tokens = {}
+
+
+def parse_cells(cells):
+
+    # Parse a Series of distinct cell strings, one row per string with the token fields
+
+    # selection: extract and separate SIR, sign and value
+    temp = cells.str.replace(r"^.*?Missing BP", "Missing_BP", n=1, regex=True)
+    temp = temp.where(cells.str.count("Missing BP") < 2)
+    # same split as extract_data: three parts separated by single spaces, the last part is ignored ("R >16 x")
+    # SIGN is the text before the first digit, VALUE runs to the last digit ("S =0.5ab " --> "=", 0.5)
+    # cells that extract_data can not split, or with a VALUE that is not a number ("S 1.2.3 "), are not valid
+    parts = temp.str.extract(r"^([^ ]*) ([^ \d]*)(\d(?:[^ ]*\d)?)[^ \d]* [^ ]*\Z")
+    value = pd.to_numeric(parts[2], errors="coerce")
+    valid = parts[0].notna() & value.notna()
+
+    # visualisation: not 'Missing BP' and not 'nip'
+    vis_valid = ~cells.str.startswith("Missing BP") & (cells != "nip")
+    digits = cells.str.replace(r"[^\d.]", "", regex=True)
+    on_scale = cells.str.contains("=", regex=False)
+    off_scale = cells.str.contains("<", regex=False) | cells.str.contains(
+        ">", regex=False
+    )
+
+    return pd.DataFrame(
+        {
+            "SIR": parts[0].where(valid, 0),
+            "SIGN": parts[1].where(valid, 0),
+            "VALUE": value.where(valid, 0.0),
+            "valid": valid,
+            "off-scale": valid & parts[1].str.contains("<|>", regex=True, na=False),
+            "first word": cells.str.split(" ").str[0],
+            "Vis valid": vis_valid,
+            "Vis SIR": cells.str[0].where(vis_valid, None),
+            "MIC": pd.to_numeric(digits.where(vis_valid), errors="coerce"),
+            "on-scale": on_scale,
+            "scale known": on_scale | off_scale,
+        }
+    )
+
+
+def token_table(cells):
+
+    # cells: any sequence of cell values
+    # Returns [codes, table]: token id of every cell and a DataFrame with one row per token id
+    # Strings that have not been seen before are parsed and added to tokens
+    cells = pd.Series(cells, dtype=object)
+    cells = cells.where(cells.map(type) == str)
+    codes, strings = pd.factorize(cells)
+
+    new = [string for string in strings if string not in tokens]
+    if new:
+        parsed = parse_cells(pd.Series(new, dtype=object))
+        tokens.update(zip(new, parsed.itertuples(index=False, name=None)))
+
+    table = pd.DataFrame(
+        [tokens[string] for string in strings] + [EMPTY_TOKEN], columns=TOKEN_COLUMNS
+    )
+
+    return [codes, table]
+
+
+def token_values(codes, table, column):
+
+    # Value of a token field for every cell, as a NumPy array
+    return table[column].to_numpy()[codes]
@@ -0,0 +1,185 @@
+# Run the isolate selection for many parameter sets, parsing the CIB only once
+
+# Each parameter set is a dict of changes to the base parameters (parameters_settings.json), for example
+# {"Bugdrug fill": [true, 3], "Point system": {...}, "Isolates per species": {"Staphylococcus aureus": {"Staphylococcus aureus": 10}}}
+# Nested dicts are merged, everything else is replaced
+
+# The CIB is parsed and ranked once per combination of "Datasets", "Kit Software Version" and species/fastidious setup
+# A different "Point system" only re-ranks the parsed data (rescore_dataset)
+# The selections and spread scores are run in parallel in a process pool
+
+# Usage: python parameter_sweep.py <sweep.json> [workers]
+# sweep.json is either a list of parameter sets or {"grid": {parameter: [value, ...], ...}}
+
+import copy
+import itertools
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+from cib_cache import read_sheet
+from delta_ingest import parse_key
+from Isolate_selection_student_project_script import (
+    read_datasets,
+    rank_dataset,
+    rescore_dataset,
+    iso_sel_setup,
+)
+
+import project_paths
+
+project_paths.add_project_folders()
+from spread_score_calc import calc_mic_spread_dict, calc_whole_panel_score
+
+# Data shared by all workers, set by init_worker
+shared = {}
+
+
+def merge_parameters(parameters, changes):
+
+    # Copy of parameters with changes applied, nested dicts are merged
+    merged = copy.deepcopy(parameters)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_parameters(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+
+    return merged
+
+
+def parameter_grid(grid):
+
+    # All combinations of the values in grid, as a list of parameter sets
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+
+
+def init_worker(data):
+
+    shared.update(data)
+
+
+def run_parameter_set(parameters):
+
+    # Selection and spread score for one parameter set, uses the parsed data in shared
+    [sorted_dataset, mic_arrays, abx, point_system] = shared["parsed"][
+        parse_key(parameters)
+    ]
+
+    if parameters["Point system"] != point_system:
+        sorted_dataset = rescore_dataset(
+            sorted_dataset, mic_arrays, parameters["Point system"]
+        )
+
+    [chosen_isolates, errors] = iso_sel_setup(
+        sorted_dataset,
+        abx,
+        parameters,
+        shared["market_prio"],
+        mic_arrays,
+        [shared["matrix_EU"], shared["abx_ranges"]],
+    )
+
+    try:
+        mic_spread_dict = calc_mic_spread_dict(
+            chosen_isolates[["Isolate"]], shared["matrix_EU"], shared["abx_ranges"]
+        )
+        panel_score = calc_whole_panel_score(mic_spread_dict)
+    except ValueError:  # too few isolates to score spread
+        panel_score = None
+
+    return {
+        "Chosen isolates": list(chosen_isolates["Isolate"]),
+        "Errors": errors,
+        "Panel score": panel_score,
+    }
+
+
+def sweep(
+    CIB,
+    parameters,
+    parameter_sets,
+    ranges,
+    abx_abbr,
+    market_prio,
+    abx_ranges,
+    workers=None,
+):
+
+    # parameters: base parameters (dict), parameter_sets: list of changes to the base parameters
+    # ranges, abx_abbr, market_prio, abx_ranges: loaded json files
+    # Returns one result per parameter set, in the same order, see run_parameter_set
+
+    all_parameters = [
+        merge_parameters(parameters, changes) for changes in parameter_sets
+    ]
+
+    # parse and rank the CIB once per parse key
+    parsed = {}
+    for p in all_parameters:
+        key = parse_key(p)
+        if key in parsed:
+            continue
+        [data, abx, data_default] = read_datasets(CIB, p)
+        [sorted_dataset, mic_arrays] = rank_dataset(
+            data, data_default, abx, p, ranges, abx_abbr
+        )
+        parsed[key] = [sorted_dataset, mic_arrays, abx, p["Point system"]]
+
+    data = {
+        "parsed": parsed,
+        "market_prio": market_prio,
+        "matrix_EU": read_sheet(CIB, "matrix EU"),
+        "abx_ranges": abx_ranges,
+    }
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(data,)
+    ) as pool:
+        results = list(pool.map(run_parameter_set, all_parameters))
+
+    for changes, result in zip(parameter_sets, results):
+        result["Parameters"] = changes
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # Input
+    CIB = "Isolate Selection Student Project/CIB_TF-data_AllIsolates_20230302.xlsx"
+    parameters = "Isolate Selection Student Project/parameters_settings.json"
+    ranges = "Isolate Selection Student Project/ranges.json"
+    abx_abbr = "Isolate Selection Student Project/abx_abbr.json"
+    market_prio = "Isolate Selection Student Project/market_prio.json"
+    abx_ranges = "Visualisation/abx_ranges.json"
+
+    parameter_sets = json.load(open(sys.argv[1]))
+    if isinstance(parameter_sets, dict):
+        parameter_sets = parameter_grid(parameter_sets["grid"])
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    results = sweep(
+        CIB,
+        json.load(open(parameters)),
+        parameter_sets,
+        json.load(open(ranges)),
+        json.load(open(abx_abbr)),
+        json.load(open(market_prio)),
+        json.load(open(abx_ranges)),
+        workers,
+    )
+
+    # Output
+    summary = pd.DataFrame(
+        {
+            "Parameters": [json.dumps(r["Parameters"]) for r in results],
+            "Isolates": [len(r["Chosen isolates"]) for r in results],
+            "Errors": [len(r["Errors"]) for r in results],
+            "Panel score": [r["Panel score"] for r in results],
+        }
+    )
+    summary.to_csv("Sweep_results.csv", index=False)
+    print(summary.to_string())
@@ -0,0 +1,114 @@
+# Stage profiling of the isolate selection
+
+# Turned on with "Profile": "<file>.json" in the parameters (empty string = off)
+# For every profiled stage it records wall time, number of calls, peak traced memory (tracemalloc)
+# and the number of rows scanned and copied by the row filters of that stage
+# The file has the summary per stage under "stages" and every call under "traceEvents",
+# so it can also be opened directly as a Chrome trace (chrome://tracing or Perfetto)
+
+# Stages run in worker processes ("Ingest workers" > 1) are not recorded
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+state = {"enabled": False, "stages": {}, "events": [], "stack": [], "start": 0.0}
+
+
+def enable():
+
+    state.update(enabled=True, stages={}, events=[], stack=[])
+    state["start"] = time.perf_counter()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+
+    state["enabled"] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def stage_record(stage):
+
+    return state["stages"].setdefault(
+        stage,
+        {
+            "calls": 0,
+            "wall time (s)": 0.0,
+            "peak memory (bytes)": 0,
+            "rows scanned": 0,
+            "rows copied": 0,
+        },
+    )
+
+
+def count(stage, rows_scanned=0, rows_copied=0):
+
+    # Add to the row counters of a stage, does nothing if profiling is off
+    if not state["enabled"]:
+        return
+    record = stage_record(stage)
+    record["rows scanned"] += int(rows_scanned)
+    record["rows copied"] += int(rows_copied)
+
+
+def profiled(stage):
+
+    # Decorator: record every call of the function as stage, only if profiling is on
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not state["enabled"]:
+                return function(*args, **kwargs)
+
+            # peak memory of nested stages also counts for the outer stage
+            stack = state["stack"]
+            if stack:
+                stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            stack.append(0)
+
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                peak = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1] = max(stack[-1], peak)
+
+                record = stage_record(stage)
+                record["calls"] += 1
+                record["wall time (s)"] += end - start
+                record["peak memory (bytes)"] = max(record["peak memory (bytes)"], peak)
+                state["events"].append(
+                    {
+                        "name": stage,
+                        "ph": "X",
+                        "ts": (start - state["start"]) * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": {"peak memory (bytes)": peak},
+                    }
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def report():
+
+    return {"stages": state["stages"], "traceEvents": state["events"]}
+
+
+def write(path):
+
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=1)
@@ -0,0 +1,20 @@
+# Import paths of the project
+
+# The isolate selection and the visualisation import modules from each other's folder
+# (e.g. the visualisation reads the CIB through cib_cache.py, the spread score selection uses spread_score_calc.py)
+# Modules call add_project_folders() before importing from the other folder, so both folders are on sys.path
+# The Visualisation folder has a project_paths.py that calls the function in this file
+
+import os
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOLDERS = ["Isolate Selection Student Project", "Visualisation"]
+
+
+def add_project_folders():
+    """Put both project folders on sys.path"""
+    for folder in FOLDERS:
+        path = os.path.join(PROJECT_DIR, folder)
+        if path not in sys.path:
+            sys.path.append(path)
@@ -4,6 +4,11 @@
 # Methods for reading, interpreting and preparing CIB for isolate selection
 
 import re
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from profiling import profiled
+from mic_tokens import token_table, token_values
 
 def cut_ranges(data,fast, a,ranges,abx_abbr,parameters):
     
@@ -15,6 +20,7 @@ def cut_ranges(data,fast, a,ranges,abx_abbr,parameters):
         kit=parameters['Kit Software Version']
     except KeyError:
         print('invalid kit software version')
+        kit=None
 
     try:
         abx=abx_abbr[a]
@@ -110,6 +116,181 @@ def extract_data(d,j,a,ranges,abx_abbr,fast,parameters):
 
     return [SIR, SIGN,VALUE,SCALE]
 
+def range_table(ranges,abx_abbr,kit):
+
+    #Reportable ranges of one kit as floats, built once instead of for every cell
+    #{antibiotic: [(low, high) non-fastidious, (low, high) fastidious]}, None if there is no range to cut to
+    #Fastidious uses the '_fast' range if there is one, same lookup as cut_ranges
+
+    table={}
+    kit_ranges=ranges.get(kit,{})
+    for abbr,a in abx_abbr.items():
+        bounds=[]
+        for key in [abbr,abbr+'_fast']:
+            if key not in kit_ranges:
+                key=abbr
+            try:
+                low,high=kit_ranges[key].split(' - ')
+                bounds.append((float(low),float(high)))
+            except (KeyError,ValueError):
+                bounds.append(None)
+        table[a]=bounds
+
+    return table
+
+def clamp_ranges(SIGN,VALUE,SCALE,low,high):
+
+    #Vectorized cut_ranges for a whole column (NumPy arrays)
+    #low, high: reportable range of every row, NaN if there is no range to cut to
+
+    below=VALUE<=low                       #if outside lower range, change to lower range
+    VALUE=np.where(below,low,VALUE)
+    off=below & (SIGN=='=')
+    SIGN=np.where(off,'<=',SIGN)
+    SCALE=np.where(off,'off-scale',SCALE)
+
+    above=VALUE>=high                      #if outside higher range, change to higher range
+    VALUE=np.where(above,high,VALUE)
+    off=above & (SIGN=='=')
+    SIGN=np.where(off,'>',SIGN)
+    SCALE=np.where(off,'off-scale',SCALE)
+
+    return [SIGN,VALUE,SCALE]
+
+@profiled('parse_matrix')
+def parse_matrix(d,abx,ranges,abx_abbr,fast,parameters):
+
+    #Vectorized version of extract_data for a whole matrix sheet
+    #fast holds the fastidious state of every row that should be parsed
+    #Returns one DataFrame per antibiotic with the columns SIR, SIGN, VALUE (float) and SCALE
+    #Cells without values ('nip', 'Missing BP', empty or not in dataset) get [0,0,0,0], like get_data
+    #Cells that extract_data can not split, or with a VALUE that is not a number, get [0,0,0,0] as well
+
+    n=len(fast)
+    d=d.iloc[:n].reset_index(drop=True).reindex(range(n))
+    fast=pd.Series(list(fast))
+
+    try:
+        kit=parameters['Kit Software Version']
+    except KeyError:
+        print('invalid kit software version')
+        kit=None
+
+    table=range_table(ranges,abx_abbr,kit)
+    fastidious=(fast=='Fastidious').to_numpy()
+
+    parsed={}
+    for a in abx:
+
+        SIR=pd.Series(0,index=d.index,dtype=object)
+        SIGN=pd.Series(0,index=d.index,dtype=object)
+        VALUE=pd.Series(0.0,index=d.index)
+        SCALE=pd.Series(0,index=d.index,dtype=object)
+
+        if a not in d.columns:
+            parsed[a]=pd.DataFrame({'SIR':SIR,'SIGN':SIGN,'VALUE':VALUE,'SCALE':SCALE})
+            continue
+
+        #every distinct cell string is parsed once, see mic_tokens.py
+        [codes,tokens]=token_table(d[a])
+        valid=pd.Series(token_values(codes,tokens,'valid'),index=d.index)
+
+        # extract and separate SIR, sign and value
+        SIR[valid]=token_values(codes,tokens,'SIR')[valid]
+        SIGN[valid]=token_values(codes,tokens,'SIGN')[valid]
+        VALUE[valid]=token_values(codes,tokens,'VALUE')[valid]
+
+        #get on-scale/off-scale information
+        if a=='Gentamicin':
+            SCALE[valid]='on-scale'
+        else:
+            off=token_values(codes,tokens,'off-scale')
+            SCALE[valid & off]='off-scale'
+            SCALE[valid & ~off]='on-scale'
+
+        if a=='D-test':
+            try:
+                CLI=pd.Series(token_values(*token_table(d['Clindamycin']),'first word'),index=d.index)
+                ERY=pd.Series(token_values(*token_table(d['Erythromycin']),'first word'),index=d.index)
+            except KeyError:
+                valid[:]=False
+            else:
+                D=pd.Series(token_values(codes,tokens,'first word'),index=d.index)
+                valid=valid & CLI.notna() & ERY.notna()
+                SCALE[valid]='-'
+                SCALE[valid & (D=='S')]='NEG'
+                SCALE[valid & (D=='R')]='NEG'
+                SCALE[valid & (D=='R') & (CLI=='S') & (ERY=='R')]='POS'
+
+        for col in [SIR,SIGN,VALUE,SCALE]:
+            col[~valid]=0
+
+        #cut to reportable range
+        parsed[a]=cut_column(pd.DataFrame({'SIR':SIR,'SIGN':SIGN,'VALUE':VALUE,'SCALE':SCALE}),a,table,fastidious)
+
+    return parsed
+
+def cut_column(p,a,table,fastidious):
+
+    #Vectorized cut_ranges for one parsed antibiotic (DataFrame from parse_matrix)
+    #table: range_table of a kit, fastidious: fastidious state of every row (bool array)
+    #Range of every row depends on fastidious state, rows without values and D-test are not cut
+
+    if a=='D-test':
+        return p
+
+    [bounds,bounds_fast]=table.get(a,[None,None])
+    if bounds is None and bounds_fast is None:
+        return p
+    bounds=bounds or (np.nan,np.nan)
+    bounds_fast=bounds_fast or (np.nan,np.nan)
+    valid=(p['SIR']!=0).to_numpy()
+    low=np.where(valid,np.where(fastidious,bounds_fast[0],bounds[0]),np.nan)
+    high=np.where(valid,np.where(fastidious,bounds_fast[1],bounds[1]),np.nan)
+    [SIGN,VALUE,SCALE]=clamp_ranges(p['SIGN'].to_numpy(),p['VALUE'].to_numpy(),p['SCALE'].to_numpy(),low,high)
+
+    return pd.DataFrame({'SIR':p['SIR'],'SIGN':SIGN,'VALUE':VALUE,'SCALE':SCALE},index=p.index)
+
+@profiled('cut_datasets')
+def cut_datasets(parsed,ranges,abx_abbr,fast,kit):
+
+    #Cut parsed datasets that were parsed without a kit ('Kit Software Version': None) to the ranges of kit
+    #Same result as parse_datasets with that kit, {dataset: {antibiotic: DataFrame}}
+
+    table=range_table(ranges,abx_abbr,kit)
+    fastidious=(pd.Series(list(fast))=='Fastidious').to_numpy()
+
+    return {t: {a: cut_column(frame,a,table,fastidious) for a,frame in p.items()} for t,p in parsed.items()}
+
+@profiled('parse_datasets')
+def parse_datasets(data,abx,ranges,abx_abbr,fast,parameters,workers=1):
+
+    #parse_matrix for every dataset, {dataset: {antibiotic: DataFrame}}
+    #If workers > 1 the antibiotics are split in blocks and parsed in a process pool
+    #Every column is parsed on its own, so the result is the same as parsing serially
+
+    if workers<=1:
+        return {t: parse_matrix(d,abx,ranges,abx_abbr,fast,parameters) for t,d in data.items()}
+
+    jobs=[]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for t,d in data.items():
+            for block in np.array_split(np.array(abx,dtype=object),workers):
+                block=list(block)
+                if not block:
+                    continue
+                #only send the columns the block needs, D-test also needs Clindamycin and Erythromycin
+                cols=block+(['Clindamycin','Erythromycin'] if 'D-test' in block else [])
+                d_block=d[[c for c in dict.fromkeys(cols) if c in d.columns]]
+                jobs.append((t,pool.submit(parse_matrix,d_block,block,ranges,abx_abbr,fast,parameters)))
+
+        parsed={t: {} for t in data}
+        for t,job in jobs:
+            parsed[t].update(job.result())
+
+    #same antibiotic order as serial parsing
+    return {t: {a: p[a] for a in abx} for t,p in parsed.items()}
+
 def comp_data(extracted_data):
 
     #only relevant if both US and EU dataset
@@ -156,6 +337,17 @@ def get_data(data, j, a,ranges,abx_abbr,fast,parameters):
     
     return final_data
 
+def get_parsed_data(parsed, j, a):
+
+    #get and compare data from parse_matrix, same result as get_data
+
+    final_data={t: p[a][j] for t,p in parsed.items()}
+
+    if len(final_data)>1:
+        final_data=comp_data(final_data)
+
+    return final_data
+
 def rank_system(res: dict, point_system: dict): 
 
    #Find info about SIR and on/offscale and give point (predefined)
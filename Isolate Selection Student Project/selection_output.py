@@ -0,0 +1,143 @@
+# Binary output of the isolate selection that can be memory-mapped
+
+# Written by main with "Binary output": "<directory>" in the parameters (empty string = off)
+# Every table is a folder with one .npy file per column, opened with np.load(mmap_mode="r"),
+# so reading it does not copy or parse anything until the values are used
+
+# Tables:
+# ranked: all isolates in Q-rank order, columns Isolate, Pathogen, Fastidious, Q-rank and Row (row in the CIB)
+# chosen: the chosen isolates in the order they were chosen, column Position (row in ranked)
+# mic: parsed values of the ranked isolates (see mic_arrays.py), column Values with shape (isolates, antibiotics, 2)
+#      antibiotics and the SIR/SIGN/SCALE codes are in meta.json
+# mic frame: valid MIC values of the chosen isolates in matrix EU, same as extract_mic_frame in the visualisation
+#            (one row per isolate and antibiotic, columns Isolate, Antibiotic, Pathogen, SIR, MIC, Log2 MIC, Scale)
+
+# Used by the visualisation scripts instead of Chosen_isolates_list.csv and the CIB, when the output folder is given
+# meta.json holds the path, size and modification time of the CIB it was made from (and its hash),
+# reading the output after that CIB has changed raises ValueError, without reading the CIB itself
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from mic_arrays import SIR_CODES, SIGN_CODES, SCALE_CODES
+from cib_cache import file_hash
+from table_store import atomic_write, text_column, write_table, read_table
+
+import project_paths
+
+project_paths.add_project_folders()
+from data_extraction_functions import extract_chosen_isolates, extract_mic_frame
+
+
+def write_selection_output(
+    directory,
+    CIB,
+    sorted_dataset,
+    mic_arrays,
+    abx,
+    chosen_isolates,
+    matrix_EU=None,
+    digest=None,
+):
+
+    # Write the ranked dataset, the chosen isolates and their MIC values to directory
+    # CIB: the CIB the selection was made from, digest: its file_hash if already known
+    # matrix_EU: matrix EU sheet of the CIB for the mic frame table, left out if None
+    rows = sorted_dataset.index.to_numpy()
+    positions = pd.Series(range(len(rows)), index=rows)
+
+    with atomic_write(directory) as tmp:
+        os.makedirs(tmp)
+
+        columns = {}
+        columns["ranked"] = write_table(
+            tmp,
+            "ranked",
+            {
+                "Isolate": text_column(sorted_dataset["Isolate"]),
+                "Pathogen": text_column(sorted_dataset["Pathogen"]),
+                "Fastidious": text_column(sorted_dataset["Fastidious"]),
+                "Q-rank": sorted_dataset["Q-rank"].to_numpy(dtype=np.int64),
+                "Row": rows.astype(np.int64),
+            },
+        )
+        columns["chosen"] = write_table(
+            tmp,
+            "chosen",
+            {"Position": positions[chosen_isolates.index].to_numpy(dtype=np.int64)},
+        )
+        columns["mic"] = write_table(
+            tmp, "mic", {"Values": np.stack([mic_arrays[a][rows] for a in abx], axis=1)}
+        )
+
+        meta = {
+            "CIB": os.path.abspath(CIB),
+            "CIB stat": cib_stat(CIB),
+            "CIB hash": digest if digest is not None else file_hash(CIB),
+            "Written": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "antibiotics": list(abx),
+            "SIR codes": SIR_CODES,
+            "SIGN codes": SIGN_CODES,
+            "SCALE codes": SCALE_CODES,
+        }
+
+        if matrix_EU is not None:
+            chosen_EU = extract_chosen_isolates(chosen_isolates[["Isolate"]], matrix_EU)
+            antibiotics = list(chosen_EU.columns[3:])
+            mic_frame = extract_mic_frame(chosen_EU, antibiotics)
+            columns["mic frame"] = write_table(
+                tmp,
+                "mic frame",
+                {
+                    "Isolate": text_column(mic_frame["Isolate"]),
+                    "Antibiotic": text_column(mic_frame["Antibiotic"]),
+                    "Pathogen": text_column(mic_frame["Pathogen"]),
+                    "SIR": text_column(mic_frame["SIR"]),
+                    "MIC": mic_frame["MIC"].to_numpy(dtype=float),
+                    "Log2 MIC": mic_frame["Log2 MIC"].to_numpy(dtype=float),
+                    "Scale": mic_frame["Scale"].to_numpy(dtype=bool),
+                },
+            )
+            meta["matrix EU antibiotics"] = antibiotics
+
+        meta["columns"] = columns
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=1)
+
+
+def cib_stat(CIB):
+
+    # [size, modification time in ns] of the CIB file
+    stat = os.stat(CIB)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_selection_output(directory, CIB=None):
+
+    # meta.json with every table as {column name: memory-mapped array} under its name
+    # Raises ValueError if the CIB the output was made from has changed since (size or modification time)
+    # CIB: also raise ValueError if the output was not made from this CIB (compares the file hash, reads the CIB)
+    with open(os.path.join(directory, "meta.json")) as f:
+        output = json.load(f)
+    source = output["CIB"]
+    if os.path.exists(source) and cib_stat(source) != output["CIB stat"]:
+        raise ValueError(
+            f"Selection output {directory} ({output['Written']}) was made before {source} changed"
+        )
+    if CIB is not None and file_hash(CIB) != output["CIB hash"]:
+        raise ValueError(
+            f"Selection output {directory} ({output['Written']}) was made from another CIB than {CIB}"
+        )
+    for name, column_names in output["columns"].items():
+        output[name] = read_table(directory, name, column_names)
+
+    return output
+
+
+def output_mic_frame(output):
+
+    # The mic frame table as the DataFrame extract_mic_frame returns
+    return pd.DataFrame(output["mic frame"])
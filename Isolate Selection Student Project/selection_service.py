@@ -0,0 +1,398 @@
+# Local isolate selection service with the parsed CIB kept in memory
+
+# The CIB is read, parsed and ranked on the first request and kept in memory, later requests only run the selection
+# Parsed data is kept per parse key (see delta_ingest.parse_key), a new "Point system" only re-ranks
+# The CIB file is checked on every request, if it has changed everything is read again (hot reload)
+
+# Only listens on localhost
+# Usage: python selection_service.py [port] (default 8765)
+
+# Requests (JSON body, parameters = changes to parameters_settings.json, like in parameter_sweep.py):
+# POST /select  {"parameters": {...}, "spread score": true}
+#               --> {"Chosen isolates": [...], "Q-rank": [...], "Errors": [...], "Panel score": float or null}
+# POST /spread  {"isolates": [...]} --> {"Scores": {antibiotic: score}, "Panel score": float}
+# GET  /status  --> CIB, loaded parse keys and when the CIB was loaded
+# From Python (e.g. a notebook): select({...}) and spread_score([...]) below
+
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+
+from cib_cache import read_sheet
+from parameter_sweep import merge_parameters
+from delta_ingest import parse_key
+from mic_arrays import SIR_CODES, SCALE_CODES
+from Isolate_selection_student_project_script import (
+    read_datasets,
+    rank_dataset,
+    rescore_dataset,
+    iso_sel_setup,
+)
+
+import project_paths
+
+project_paths.add_project_folders()
+from spread_score_calc import calc_mic_spread_dict, calc_whole_panel_score
+
+PORT = 8765
+
+# Data regions with a matrix sheet in the CIB
+DATASETS = ["US", "EU"]
+
+
+class RequestError(ValueError):
+
+    # Bad request, answered with 400, any other error is logged and answered with 500
+    pass
+
+
+def is_count(n):
+
+    return isinstance(n, int) and not isinstance(n, bool) and n >= 0
+
+
+def check_parameters(changes, base):
+
+    # Request parameters (changes to base) merged into base, shapes and types are checked
+    # before parsing so a bad request gets a 400 reply
+    # Raises RequestError
+    if not isinstance(changes, dict):
+        raise RequestError(f"parameters must be a dict, not {changes!r}")
+    parameters = merge_parameters(base, changes)
+
+    datasets = parameters.get("Datasets")
+    if (
+        not isinstance(datasets, list)
+        or not datasets
+        or any(d not in DATASETS for d in datasets)
+    ):
+        raise RequestError(f"Datasets must be a list of {DATASETS}, not {datasets!r}")
+
+    # {"Fill group": bool, group: {species: n, ..., "Overall": n, "Fastidious": text}, ...}
+    species = parameters.get("Isolates per species")
+    if not isinstance(species, dict) or list(species)[:1] != ["Fill group"]:
+        raise RequestError(
+            "Isolates per species must be a dict starting with 'Fill group'"
+        )
+    for group, v in list(species.items())[1:]:
+        if not isinstance(v, dict):
+            raise RequestError(
+                f"Isolates per species: {group!r} must be a dict, not {v!r}"
+            )
+        for pat, n in v.items():
+            if pat == "Fastidious":
+                continue
+            if not is_count(n):
+                raise RequestError(
+                    f"Isolates per species: {group!r} {pat!r} must be a count, not {n!r}"
+                )
+
+    # {label: points}, labels as in mic_arrays.rank_arrays
+    point_system = parameters.get("Point system")
+    if not isinstance(point_system, dict):
+        raise RequestError("Point system must be a dict")
+    labels = SIR_CODES[1:] + SCALE_CODES[1:]
+    for label, points in point_system.items():
+        if label not in labels:
+            raise RequestError(
+                f"Point system: unknown label {label!r}, known labels: {labels}"
+            )
+        if isinstance(points, bool) or not isinstance(points, (int, float)):
+            raise RequestError(
+                f"Point system: points for {label!r} must be a number, not {points!r}"
+            )
+
+    # [on, count]
+    for name in ["Upper fill", "Bugdrug fill", "Lower limit"]:
+        value = parameters.get(name)
+        if (
+            not isinstance(value, list)
+            or len(value) != 2
+            or not isinstance(value[0], bool)
+            or not is_count(value[1])
+        ):
+            raise RequestError(f"{name} must be [true/false, count], not {value!r}")
+
+    # {"SIR": text, "scale": text, "POS": true/false/""}, see get_bugdrug_fill
+    for name, value in parameters.items():
+        if not name.startswith("Bugdrug fill requirements"):
+            continue
+        if (
+            not isinstance(value, dict)
+            or not isinstance(value.get("SIR"), str)
+            or not isinstance(value.get("scale"), str)
+            or not (isinstance(value.get("POS"), bool) or value.get("POS") == "")
+        ):
+            raise RequestError(
+                f'{name} must be {{"SIR": text, "scale": text, "POS": true/false/""}}, not {value!r}'
+            )
+
+    mode = parameters.get("Selection mode", "Q-rank")
+    if mode not in ["Q-rank", "Spread score"]:
+        raise RequestError(
+            f"Selection mode must be 'Q-rank' or 'Spread score', not {mode!r}"
+        )
+    budget = parameters.get("Spread time budget", 2)
+    if isinstance(budget, bool) or not isinstance(budget, (int, float)) or budget < 0:
+        raise RequestError(
+            f"Spread time budget must be a number of seconds, not {budget!r}"
+        )
+
+    return parameters
+
+
+class SelectionService:
+
+    # Parsed CIB and input files, shared by all requests
+
+    def __init__(self, CIB, parameters, ranges, abx_abbr, market_prio, abx_ranges):
+        self.CIB = CIB
+        self.parameters = parameters
+        self.ranges = ranges
+        self.abx_abbr = abx_abbr
+        self.market_prio = market_prio
+        self.abx_ranges = abx_ranges
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+
+        self.parsed = {}
+        self.matrix_EU = None
+        self.stat = self.file_stat()
+        self.loaded = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def file_stat(self):
+
+        stat = os.stat(self.CIB)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check_reload(self):
+
+        # Forget all parsed data if the CIB has changed since it was read
+        if self.file_stat() != self.stat:
+            self.clear()
+
+    def ranked(self, parameters):
+
+        # [sorted_dataset, mic_arrays, abx] for checked parameters, parsed once per parse key
+        key = parse_key(parameters)
+        if key not in self.parsed:
+            [data, abx, data_default] = read_datasets(self.CIB, parameters)
+            [sorted_dataset, mic_arrays] = rank_dataset(
+                data, data_default, abx, parameters, self.ranges, self.abx_abbr
+            )
+            self.parsed[key] = [
+                sorted_dataset,
+                mic_arrays,
+                abx,
+                parameters["Point system"],
+            ]
+
+        [sorted_dataset, mic_arrays, abx, point_system] = self.parsed[key]
+        if parameters["Point system"] != point_system:
+            sorted_dataset = rescore_dataset(
+                sorted_dataset, mic_arrays, parameters["Point system"]
+            )
+
+        return [sorted_dataset, mic_arrays, abx]
+
+    def get_matrix_EU(self):
+
+        if self.matrix_EU is None:
+            self.matrix_EU = read_sheet(self.CIB, "matrix EU")
+        return self.matrix_EU
+
+    def panel_scores(self, isolates):
+
+        mic_spread_dict = calc_mic_spread_dict(
+            isolates, self.get_matrix_EU(), self.abx_ranges
+        )
+        return {
+            "Scores": {a: score for a, (_, score) in mic_spread_dict.items()},
+            "Panel score": calc_whole_panel_score(mic_spread_dict),
+        }
+
+    def select(self, request):
+
+        with self.lock:
+            self.check_reload()
+            parameters = check_parameters(
+                request.get("parameters", {}), self.parameters
+            )
+            [sorted_dataset, mic_arrays, abx] = self.ranked(parameters)
+
+            spread_data = None
+            if parameters.get("Selection mode", "Q-rank") == "Spread score":
+                spread_data = [self.get_matrix_EU(), self.abx_ranges]
+
+            [chosen_isolates, errors] = iso_sel_setup(
+                sorted_dataset,
+                abx,
+                parameters,
+                self.market_prio,
+                mic_arrays,
+                spread_data,
+            )
+
+            panel_score = None
+            if request.get("spread score"):
+                try:
+                    panel_score = self.panel_scores(chosen_isolates[["Isolate"]])[
+                        "Panel score"
+                    ]
+                except ValueError:  # too few isolates to score spread
+                    pass
+
+        return {
+            "Chosen isolates": chosen_isolates["Isolate"].tolist(),
+            "Q-rank": chosen_isolates["Q-rank"].tolist(),
+            "Errors": errors.to_dict("records"),
+            "Panel score": panel_score,
+        }
+
+    def spread(self, request):
+
+        with self.lock:
+            self.check_reload()
+            isolates = request.get("isolates")
+            if not isinstance(isolates, list) or not all(
+                isinstance(isolate, str) for isolate in isolates
+            ):
+                raise RequestError(
+                    f"isolates must be a list of isolate names, not {isolates!r}"
+                )
+            isolates = pd.DataFrame({"Isolate": isolates})
+            return self.panel_scores(isolates)
+
+    def status(self):
+
+        with self.lock:
+            self.check_reload()
+            return {
+                "CIB": os.path.abspath(self.CIB),
+                "Loaded": self.loaded,
+                "Parse keys": list(self.parsed),
+            }
+
+
+def make_handler(service):
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, status, body):
+            data = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/status":
+                self.reply(200, service.status())
+            else:
+                self.reply(404, {"Error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            routes = {"/select": service.select, "/spread": service.spread}
+            if self.path not in routes:
+                self.reply(404, {"Error": f"Unknown path {self.path}"})
+                return
+            try:
+                self.reply(200, routes[self.path](self.read_request()))
+            except RequestError as e:
+                self.reply(400, {"Error": str(e)})
+            except Exception as e:
+                traceback.print_exc()
+                self.reply(
+                    500,
+                    {
+                        "Error": f"Internal error ({type(e).__name__}), see the service log"
+                    },
+                )
+
+        def read_request(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                raise RequestError(f"request body is not JSON: {e}")
+            if not isinstance(request, dict):
+                raise RequestError("request body must be a JSON object")
+            return request
+
+        def log_message(self, format, *args):
+            sys.stderr.write(f"[{self.log_date_time_string()}] {format % args}\n")
+
+    return Handler
+
+
+def serve(service, port=PORT):
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(service))
+    print(f"Isolate selection service on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Client
+
+
+def request(path, body=None, port=PORT):
+
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}{path}",
+        data=data,
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+def select(parameters=None, spread_score=False, port=PORT):
+
+    # Run the selection on the service, parameters = changes to the service's base parameters
+    return request(
+        "/select",
+        {"parameters": parameters or {}, "spread score": spread_score},
+        port,
+    )
+
+
+def spread_score(isolates, port=PORT):
+
+    return request("/spread", {"isolates": list(isolates)}, port)
+
+
+if __name__ == "__main__":
+
+    # Input
+    CIB = "Isolate Selection Student Project/CIB_TF-data_AllIsolates_20230302.xlsx"
+    parameters = "Isolate Selection Student Project/parameters_settings.json"
+    ranges = "Isolate Selection Student Project/ranges.json"
+    abx_abbr = "Isolate Selection Student Project/abx_abbr.json"
+    market_prio = "Isolate Selection Student Project/market_prio.json"
+    abx_ranges = "Visualisation/abx_ranges.json"
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+
+    service = SelectionService(
+        CIB,
+        json.load(open(parameters)),
+        json.load(open(ranges)),
+        json.load(open(abx_abbr)),
+        json.load(open(market_prio)),
+        json.load(open(abx_ranges)),
+    )
+    serve(service, port)
@@ -0,0 +1,240 @@
+# Isolate selection that maximises the whole panel spread score (see Visualisation/spread_score_calc.py)
+
+# Used instead of the Q-rank selection with "Selection mode": "Spread score" in the parameters
+# Constraints are the same as in the Q-rank selection:
+# isolates per species (species_fill), overall isolates per group ("Fill group", group_fill),
+# upper fill and lower limit
+# The bugdrug fill is not used, the spread score decides which isolates are interesting
+
+# 1. Greedy: every quota is filled one isolate at a time with the isolate that raises the panel score the most
+# 2. Local search: a chosen isolate is swapped with an isolate from the same quota if that raises the panel score,
+#    until no swap helps
+# Ties are broken by Q-rank, so with equal spread the most interesting isolate is chosen
+# "Spread time budget" (seconds, default 2) counts from the start of iso_sel_setup,
+# including building the selection index, the spread tracker and the slot groups. Both steps stop when it has passed,
+# quotas that are not filled by then are filled in Q-rank order from their pools
+# iso_sel_setup also runs the Q-rank selection and keeps it if the budget has passed before the search starts
+# (e.g. a budget of 0) or if it has the higher panel score, so this mode never scores lower than Q-rank
+
+# Only isolates that fill an empty slot of the spread lists can change the panel score,
+# and isolates with the same filled slots score the same, so only the first isolate (highest Q-rank)
+# of every slot group that fills an empty slot is scored
+
+import time
+import numpy as np
+import pandas as pd
+
+import project_paths
+
+project_paths.add_project_folders()
+from data_extraction_functions import extract_mic_frame
+from incremental_spread_score import IncrementalSpreadScore, spread_scores
+from mic_arrays import pack_bits
+from profiling import profiled
+
+
+@profiled("spread_tracker")
+def spread_tracker(matrix_EU, isolates, abx_ranges):
+
+    # IncrementalSpreadScore with all isolates that can be chosen, MIC values from matrix EU
+    # Antibiotics without a concentration range in abx_ranges are not scored
+    rows = matrix_EU[matrix_EU["Isolate"].isin(isolates)]
+    antibiotics = [a for a in rows.columns[3:] if a in abx_ranges]
+    mic_frame = extract_mic_frame(rows, antibiotics)
+
+    return IncrementalSpreadScore(abx_ranges, mic_frame)
+
+
+def limit_quota(parameters, chosen_isolates, n):
+
+    # Same as in species_fill/group_fill: never choose more than the lower limit in total
+    if parameters["Lower limit"][0]:
+        return max(min(n, parameters["Lower limit"][1] - len(chosen_isolates)), 0)
+    return n
+
+
+# Number of candidates scored at once, the time budget is checked between blocks
+SCORE_BLOCK = 2048
+
+
+def slot_groups(tracker, names):
+
+    # Rows with the same filled slots (spread list slots of all antibiotics) share a group
+    # Returns the group of every row and the filled slots of every group as bitsets
+    [rows, slots] = tracker.isolate_slot_pairs(names)
+    bits = np.zeros((len(names), -(-tracker.counts.size // 64)), dtype=np.uint64)
+    np.bitwise_or.at(
+        bits, (rows, slots >> 6), np.uint64(1) << (slots & 63).astype(np.uint64)
+    )
+    [bits, group] = np.unique(bits, axis=0, return_inverse=True)
+
+    return {"group": group.reshape(-1), "bits": bits}
+
+
+def best_candidate(tracker, names, groups, candidates, deadline, remove=()):
+
+    # Candidate row (rows in Q-rank order) that gives the highest panel score when added after removing
+    # the isolates in remove, first in Q-rank order if equal. Returns [row, score], None if the deadline passed
+    if time.perf_counter() > deadline:
+        return None
+    [_, counts] = tracker.changed_rows(remove=remove)
+    filled = counts > 0
+    baseline = spread_scores(tracker.in_range, filled).mean()
+
+    # first row of every group
+    [group_ids, first] = np.unique(groups["group"][candidates], return_index=True)
+    order = np.argsort(first)
+    group_ids, rows = group_ids[order], candidates[first[order]]
+
+    # groups that fill no empty slot keep the panel score
+    fills = (groups["bits"][group_ids] & ~pack_bits(filled.ravel())).any(axis=1)
+    scores = np.full(len(rows), baseline)
+    scored = np.flatnonzero(fills)
+    for start in range(0, len(scored), SCORE_BLOCK):
+        if time.perf_counter() > deadline:
+            return None
+        block = scored[start : start + SCORE_BLOCK]
+        scores[block] = tracker.panel_scores_after_adding(names[rows[block]], remove)
+
+    best = np.argmax(scores)  # first best = highest Q-rank
+    return [rows[best], scores[best]]
+
+
+@profiled("greedy_fill")
+def greedy_fill(tracker, names, groups, available, pool, n, deadline):
+
+    # Choose n isolates from pool (rows in Q-rank order), one at a time
+    # After the deadline the rest is chosen in Q-rank order
+    # Returns the chosen rows
+    chosen = []
+    for _ in range(n):
+        candidates = pool[available[pool]]
+        if len(candidates) == 0:
+            break
+        best = None
+        if time.perf_counter() <= deadline:
+            best = best_candidate(tracker, names, groups, candidates, deadline)
+        row = candidates[0] if best is None else best[0]
+        tracker.add(names[row])
+        available[row] = False
+        chosen.append(row)
+
+    return chosen
+
+
+@profiled("local_search")
+def local_search(tracker, names, groups, available, chosen, pools, deadline):
+
+    # Swap chosen isolates with available isolates from the same pool while the panel score increases
+    # chosen: list of [row, pool key], changed in place
+    improved = True
+    while improved:
+        improved = False
+        for k, (row, key) in enumerate(chosen):
+            candidates = pools[key][available[pools[key]]]
+            if len(candidates) == 0:
+                continue
+            best = best_candidate(
+                tracker, names, groups, candidates, deadline, remove=[names[row]]
+            )
+            if best is None:
+                return
+            if best[1] > tracker.panel_score() + 1e-12:
+                tracker.update(add=[names[best[0]]], remove=[names[row]])
+                available[row] = True
+                available[best[0]] = False
+                chosen[k] = [best[0], key]
+                improved = True
+
+
+@profiled("spread_selection")
+def spread_selection(
+    index, available, parameters, errors, pats_groups, names, tracker, deadline
+):
+
+    # Same input and output as isolate_selection + upper_fill
+    # names: isolate name of every row, tracker: spread_tracker of all isolates
+    # deadline: time.perf_counter() value when the search stops, see "Spread time budget"
+    groups = slot_groups(tracker, names)
+    chosen = []  # [row, pool key]
+    pools = {}
+
+    def chosen_rows():
+        return [row for row, key in chosen]
+
+    for pat_group in pats_groups:
+
+        subspecies = index["groups"][pat_group]["Subspecies"]
+
+        # Species fill
+        for pat in subspecies:
+            isos_req = index["pathogens"][pat]["Target"]
+            isos_req = limit_quota(parameters, chosen_rows(), isos_req)
+            key = ("Species", pat)
+            pools[key] = index["pathogen rows"].get(pat, np.array([], dtype=int))
+
+            rows = greedy_fill(
+                tracker, names, groups, available, pools[key], isos_req, deadline
+            )
+            chosen += [[row, key] for row in rows]
+
+            if len(rows) != isos_req:
+                errors = pd.concat(
+                    [
+                        errors,
+                        pd.DataFrame(
+                            {
+                                "Pathogen": [f"{pat}:"],
+                                "Message": f"Not enough isolates in first selection, {len(rows)}/{isos_req} isolates were selected",
+                            }
+                        ),
+                    ]
+                )
+
+        # Group fill
+        if parameters["Isolates per species"]["Fill group"]:
+            overall = index["groups"][pat_group]["Overall"]
+            group_pats = index["groups"][pat_group]["Subspecies"]
+            key = ("Group", pat_group)
+            pools[key] = index["order"][np.isin(index["pathogen"], group_pats)]
+
+            chosen_group = int(
+                np.isin(index["pathogen by row"][chosen_rows()], subspecies).sum()
+            )
+            remain = limit_quota(
+                parameters, chosen_rows(), max(overall - chosen_group, 0)
+            )
+
+            rows = greedy_fill(
+                tracker, names, groups, available, pools[key], remain, deadline
+            )
+            chosen += [[row, key] for row in rows]
+
+            chosen_tot = chosen_group + len(rows)
+            if chosen_tot < overall:
+                errors = pd.concat(
+                    [
+                        errors,
+                        pd.DataFrame(
+                            {
+                                "Pathogen": [f"{pat_group}:"],
+                                "Message": f"Not enough isolates in group fill, {chosen_tot}/{overall} isolates were selected",
+                            }
+                        ),
+                    ]
+                )
+
+    # Upper fill
+    if parameters["Upper fill"][0] and not parameters["Lower limit"][0]:
+        diff = max(parameters["Upper fill"][1] - len(chosen), 0)
+        key = ("Upper fill",)
+        pools[key] = index["order"]
+        rows = greedy_fill(
+            tracker, names, groups, available, pools[key], diff, deadline
+        )
+        chosen += [[row, key] for row in rows]
+
+    # Swap isolates within their quota while time is left
+    local_search(tracker, names, groups, available, chosen, pools, deadline)
+
+    return [available, chosen_rows(), errors]
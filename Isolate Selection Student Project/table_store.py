@@ -0,0 +1,185 @@
+# Columnar tables on disk, used by the CIB cache, the stored CIB revisions and the binary selection output
+
+# A table is a folder with one .npy file per column, opened with np.load(mmap_mode="r")
+# np.load never unpickles (allow_pickle is off), so reading a cache file can not run code
+
+# DataFrames with Python objects in their cells (CIB sheets, the ranked dataset) are stored with write_frame:
+# every cell gets a kind code (see cell_kind) and its value goes to a plain array for that kind,
+# text and JSON cells (dicts and lists) as codes into one array of unique strings
+# Missing values (None, NaN, NaT) are read back as NaN, like pd.read_excel gives them
+
+# Files and folders are written to a temporary path first and moved into place when complete (atomic_write)
+
+import datetime
+import json
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+# Kind code of a cell in write_frame
+MISSING, TEXT, FLOAT, INT, BOOL, TIMESTAMP, JSON = range(7)
+
+
+def remove(path):
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+@contextmanager
+def atomic_write(path):
+
+    # Temporary path to write a file or folder to, moved to path when the block ends without error
+    # so an interrupted run never leaves a broken file behind
+    tmp = path + ".tmp"
+    remove(tmp)
+    try:
+        yield tmp
+        # a folder can only be replaced by a folder once the old one is gone
+        if os.path.isdir(path):
+            remove(path)
+        os.replace(tmp, path)
+    finally:
+        remove(tmp)
+
+
+def text_column(values):
+
+    # Fixed width strings, object arrays can not be memory-mapped
+    return np.array([str(value) for value in values], dtype=str)
+
+
+def write_table(directory, name, columns):
+
+    # columns: {column name: array}, written in this order
+    os.makedirs(os.path.join(directory, name))
+    for k, values in enumerate(columns.values()):
+        np.save(os.path.join(directory, name, f"{k}.npy"), np.ascontiguousarray(values))
+
+    return list(columns)
+
+
+def read_table(directory, name, column_names, mmap_mode="r"):
+
+    # {column name: array}, memory-mapped unless mmap_mode is None
+    return {
+        column: np.load(os.path.join(directory, name, f"{k}.npy"), mmap_mode=mmap_mode)
+        for k, column in enumerate(column_names)
+    }
+
+
+def cell_kind(value):
+
+    # bool before int, bool is a subclass of int
+    if isinstance(value, str):
+        return TEXT
+    if isinstance(value, (bool, np.bool_)):
+        return BOOL
+    if isinstance(value, (int, np.integer)):
+        return INT
+    if isinstance(value, (float, np.floating)):
+        return MISSING if np.isnan(value) else FLOAT
+    if value is None or value is pd.NaT:
+        return MISSING
+    if isinstance(value, datetime.datetime):
+        return TIMESTAMP
+    if isinstance(value, (dict, list)):
+        return JSON
+    raise TypeError(f"Cells of type {type(value).__name__} can not be stored")
+
+
+def object_array(values):
+
+    # 1-D object array, also for lists of lists that NumPy would turn into a 2-D array
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
+
+
+def write_frame(directory, name, frame):
+
+    # frame as table name in directory, returns the meta data read_frame needs (JSON)
+    # Raises TypeError for cells or column names that can not be stored
+    kinds = np.empty(frame.size, dtype="i1")
+    text = []
+    numbers = []
+    integers = []
+    booleans = []
+    timestamps = []
+    for i, value in enumerate(frame.to_numpy(dtype=object).ravel()):
+        kind = cell_kind(value)
+        kinds[i] = kind
+        if kind == TEXT:
+            text.append(value)
+        elif kind == JSON:
+            text.append(json.dumps(value))
+        elif kind == FLOAT:
+            numbers.append(value)
+        elif kind == INT:
+            integers.append(int(value))
+        elif kind == BOOL:
+            booleans.append(bool(value))
+        elif kind == TIMESTAMP:
+            timestamps.append(pd.Timestamp(value).value)
+    [codes, strings] = pd.factorize(pd.Series(text, dtype=object))
+
+    meta = {
+        "columns": list(frame.columns),
+        "dtypes": [str(dtype) for dtype in frame.dtypes],
+        "range index": isinstance(frame.index, pd.RangeIndex)
+        and frame.index.equals(pd.RangeIndex(len(frame))),
+    }
+    json.dumps(meta)  # column names that JSON can not hold raise TypeError here
+
+    meta["arrays"] = write_table(
+        directory,
+        name,
+        {
+            "kinds": kinds.reshape(frame.shape),
+            "codes": codes.astype(np.int32),
+            "strings": text_column(strings),
+            "numbers": np.array(numbers, dtype=float),
+            "integers": np.array(integers, dtype=np.int64),
+            "booleans": np.array(booleans, dtype=bool),
+            "timestamps": np.array(timestamps, dtype=np.int64),
+            "index": frame.index.to_numpy(dtype=np.int64),
+        },
+    )
+
+    return meta
+
+
+def read_frame(directory, name, meta):
+
+    # The DataFrame written by write_frame
+    arrays = read_table(directory, name, meta["arrays"])
+    kinds = arrays["kinds"]
+
+    values = np.full(kinds.shape, np.nan, dtype=object)
+    values[(kinds == TEXT) | (kinds == JSON)] = np.asarray(arrays["strings"]).astype(
+        object
+    )[arrays["codes"]]
+    json_cells = kinds == JSON
+    if json_cells.any():
+        values[json_cells] = object_array([json.loads(v) for v in values[json_cells]])
+    values[kinds == FLOAT] = arrays["numbers"]
+    values[kinds == INT] = arrays["integers"]
+    values[kinds == BOOL] = arrays["booleans"]
+    values[kinds == TIMESTAMP] = object_array(
+        [pd.Timestamp(v) for v in arrays["timestamps"]]
+    )
+
+    index = None if meta["range index"] else np.asarray(arrays["index"])
+    frame = pd.DataFrame(values, index=index, columns=meta["columns"])
+    dtypes = {
+        column: dtype
+        for column, dtype in zip(meta["columns"], meta["dtypes"])
+        if dtype != "object"
+    }
+
+    return frame.astype(dtypes) if dtypes else frame
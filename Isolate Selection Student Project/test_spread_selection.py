@@ -0,0 +1,72 @@
+# Tests of the spread score selection on synthetic CIB data (see benchmark.py)
+
+# The spread score selection replaces the Q-rank selection, so its panel score must never be lower,
+# also when the time budget has passed before the search starts
+
+import json
+import os
+import numpy as np
+import pytest
+
+import Isolate_selection_student_project_script as selection
+from benchmark import ANTIBIOTICS, HERE, synthetic_cib
+from spread_score_calc import calc_mic_spread_dict, calc_whole_panel_score
+
+
+def load(name):
+
+    with open(os.path.join(HERE, name)) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def ranked():
+
+    parameters = dict(load("parameters_settings.json"), Datasets=["EU"])
+    data = {"EU": synthetic_cib(2000, parameters, seed=1)["EU"]}
+    abx = list(np.unique(ANTIBIOTICS))
+    [sorted_dataset, mic_arrays] = selection.rank_dataset(
+        data, data["EU"], abx, parameters, load("ranges.json"), load("abx_abbr.json")
+    )
+    abx_ranges = load(os.path.join("..", "Visualisation", "abx_ranges.json"))
+
+    return [parameters, data["EU"], abx, sorted_dataset, mic_arrays, abx_ranges]
+
+
+def select(ranked, **options):
+
+    [parameters, matrix_EU, abx, sorted_dataset, mic_arrays, abx_ranges] = ranked
+    [chosen_isolates, errors] = selection.iso_sel_setup(
+        sorted_dataset,
+        abx,
+        dict(parameters, **options),
+        load("market_prio.json"),
+        mic_arrays,
+        [matrix_EU, abx_ranges],
+    )
+    panel_score = calc_whole_panel_score(
+        calc_mic_spread_dict(chosen_isolates[["Isolate"]], matrix_EU, abx_ranges)
+    )
+
+    return [list(chosen_isolates["Isolate"]), panel_score]
+
+
+@pytest.mark.parametrize("budget", [0, 0.05, 2])
+def test_spread_score_not_lower_than_qrank(ranked, budget):
+
+    [_, qrank_score] = select(ranked, **{"Selection mode": "Q-rank"})
+    [_, spread_score] = select(
+        ranked, **{"Selection mode": "Spread score", "Spread time budget": budget}
+    )
+
+    assert spread_score >= qrank_score
+
+
+def test_spread_without_budget_is_qrank_selection(ranked):
+
+    [qrank_isolates, _] = select(ranked, **{"Selection mode": "Q-rank"})
+    [spread_isolates, _] = select(
+        ranked, **{"Selection mode": "Spread score", "Spread time budget": 0}
+    )
+
+    assert spread_isolates == qrank_isolates
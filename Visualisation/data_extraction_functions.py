@@ -1,6 +1,11 @@
 import pandas as pd
 import numpy as np
 
+import project_paths
+
+project_paths.add_project_folders()
+from mic_tokens import token_table, token_values
+
 
 def extract_chosen_isolates(
     chosen_isolates: pd.DataFrame, matrix_EU: pd.DataFrame
@@ -102,3 +107,43 @@ def extract_mic_data(chosen_isolates_SIR: dict, antibiotics: list) -> list:
             )
         mic_values.append(antibiotic_mic_values)
     return mic_values
+
+
+def extract_mic_frame(chosen_isolates: pd.DataFrame, antibiotics: list) -> pd.DataFrame:
+    """
+    Columnar version of extract_SIR, filter_mic_values and extract_mic_data.
+    Returns a long DataFrame with one row per isolate and antibiotic with a
+    valid SIR, ordered by antibiotic and then isolate. Columns: Isolate,
+    Antibiotic, Pathogen, SIR, MIC, Log2 MIC and Scale (True == on-scale).
+    """
+    long = chosen_isolates.melt(
+        id_vars=list(chosen_isolates.columns[:2]),
+        value_vars=antibiotics,
+        var_name="Antibiotic",
+        value_name="Cell",
+    )
+    long.columns = ["Isolate", "Pathogen", "Antibiotic", "Cell"]
+
+    # Every distinct cell string is parsed once (see mic_tokens.py)
+    # Same rules as parse_SIR, find_digits and get_scale, empty cells are not valid either
+    [codes, tokens] = token_table(long["Cell"])
+    valid = token_values(codes, tokens, "Vis valid")
+    long, codes = long[valid], codes[valid]
+
+    mic = token_values(codes, tokens, "MIC").astype(float)
+    if np.isnan(mic).any():
+        raise ValueError("could not convert string to float")
+    if not token_values(codes, tokens, "scale known").all():
+        raise ValueError("Not a valid SIR")
+
+    return pd.DataFrame(
+        {
+            "Isolate": long["Isolate"].to_numpy(),
+            "Antibiotic": long["Antibiotic"].to_numpy(),
+            "Pathogen": long["Pathogen"].to_numpy(),
+            "SIR": token_values(codes, tokens, "Vis SIR"),
+            "MIC": mic,
+            "Log2 MIC": np.log2(mic),
+            "Scale": token_values(codes, tokens, "on-scale").astype(bool),
+        }
+    )
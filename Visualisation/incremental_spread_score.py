@@ -0,0 +1,220 @@
+# Spread score of a panel that can be updated one isolate at a time
+
+# Keeps the number of chosen isolates in every slot of the concentration grid
+# (Min C to Max C) for every antibiotic. Adding or removing an isolate only
+# rescores the antibiotics where a slot went from empty to filled or back,
+# so candidate panel changes can be evaluated quickly by an optimiser
+
+# Gives the same scores as spread_score_calc.calc_mic_spread_dict:
+# the valid part of a spread list is the concentration range of the antibiotic
+# plus filled slots outside it, gaps of n empty slots cost n - 1 and empty edges 0.5
+
+import numpy as np
+import pandas as pd
+
+from spread_score_calc import total_concentration_range
+
+N_SLOTS = len(total_concentration_range)
+
+
+def concentration_slot(mic_values: np.ndarray) -> np.ndarray:
+    """Slot of every MIC value, same as the index used by fill_mic_spread_list"""
+    index = np.trunc(np.log2(mic_values) + 10).astype(int)
+    # negative indices count from the end like a list index
+    index = np.where(index < 0, index + N_SLOTS, index)
+    if ((index < 0) | (index >= N_SLOTS)).any():
+        raise IndexError("list assignment index out of range")
+    return index
+
+
+def spread_scores(in_range: np.ndarray, filled: np.ndarray) -> np.ndarray:
+    """
+    Spread score of every spread list in filled, shape (..., N_SLOTS).
+    in_range marks the slots inside the concentration range and is broadcast to filled.
+    """
+    valid = in_range | filled
+    empty = valid & ~filled
+
+    n_valid = valid.sum(axis=-1)
+    if (n_valid <= 1).any():
+        raise ValueError("Length of valid list must be greater than 1")
+
+    # every gap of n empty slots costs n - 1: number of empty slots minus number of gaps
+    # empty slots are always inside the range, so a gap starts where the slot before is not empty
+    gap_start = empty.copy()
+    gap_start[..., 1:] &= ~empty[..., :-1]
+    penalty = empty.sum(axis=-1) - gap_start.sum(axis=-1)
+
+    # 0.5 for each empty edge
+    first = valid.argmax(axis=-1)[..., None]
+    last = N_SLOTS - 1 - valid[..., ::-1].argmax(axis=-1)[..., None]
+    penalty = penalty + 0.5 * np.take_along_axis(empty, first, axis=-1)[..., 0]
+    penalty = penalty + 0.5 * np.take_along_axis(empty, last, axis=-1)[..., 0]
+
+    return 1 - penalty / n_valid
+
+
+class IncrementalSpreadScore:
+    """
+    Occupancy counts and spread scores of a panel of isolates.
+
+    antibiotics_ranges: the abx_ranges.json dict, one score per antibiotic in it.
+    mic_frame: long frame from extract_mic_frame with all isolates that can be
+    added to the panel. The panel starts empty.
+    """
+
+    def __init__(self, antibiotics_ranges: dict, mic_frame: pd.DataFrame):
+        self.antibiotics = list(antibiotics_ranges)
+        n_abx = len(self.antibiotics)
+
+        # Slots inside the concentration range of each antibiotic, see create_mic_spread_dict
+        concentration_to_index_convert = {
+            concentration: index
+            for index, concentration in enumerate(total_concentration_range)
+        }
+        self.in_range = np.ones((n_abx, N_SLOTS), dtype=bool)
+        for i, ranges in enumerate(antibiotics_ranges.values()):
+            lower_limit, upper_limit = ranges["Lower"], ranges["Upper"]
+            if lower_limit == "Min_C" and upper_limit == "Max_C":
+                continue
+            lower_limit_index = concentration_to_index_convert[lower_limit]
+            upper_limit_index = concentration_to_index_convert[upper_limit]
+            self.in_range[i, :lower_limit_index] = False
+            self.in_range[i, upper_limit_index + 1 :] = False
+
+        # Filled slots of every isolate, as flat indices antibiotic * N_SLOTS + slot
+        abx_index = {antibiotic: i for i, antibiotic in enumerate(self.antibiotics)}
+        unknown = set(mic_frame["Antibiotic"]) - set(abx_index)
+        if unknown:
+            raise KeyError(sorted(unknown)[0])
+        flat = mic_frame["Antibiotic"].map(abx_index).to_numpy() * N_SLOTS
+        flat += concentration_slot(mic_frame["MIC"].to_numpy())
+
+        # sorted unique slots per isolate, all isolates at once
+        size = n_abx * N_SLOTS
+        codes, isolates = pd.factorize(mic_frame["Isolate"].to_numpy())
+        keep = codes >= 0
+        pairs = np.sort(codes[keep].astype(np.int64) * size + flat[keep])
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+        slots = pairs % size
+        bounds = np.searchsorted(pairs // size, np.arange(len(isolates) + 1))
+        self.isolate_slots = {
+            isolate: slots[bounds[k] : bounds[k + 1]]
+            for k, isolate in enumerate(isolates)
+        }
+        # same slots as flat arrays, for isolate_slot_pairs
+        self.slot_index = pd.Index(isolates)
+        self.slot_bounds = bounds
+        self.slot_values = slots
+
+        self.counts = np.zeros((n_abx, N_SLOTS), dtype=np.int32)
+        self.isolates = set()
+        self.scores = self.score_rows(np.arange(n_abx), self.counts)
+
+    def isolate_slot_pairs(self, isolates) -> list:
+        """
+        Filled slots of all isolates at once, as [position in isolates, flat slot] arrays.
+        Isolates without MIC values fill no slots.
+        """
+        k = self.slot_index.get_indexer(isolates)
+        known = k >= 0
+        start = np.where(known, self.slot_bounds[k], 0)
+        length = np.where(known, self.slot_bounds[k + 1] - start, 0)
+
+        positions = np.repeat(np.arange(len(k)), length)
+        offsets = np.arange(length.sum()) - np.repeat(
+            np.cumsum(length) - length, length
+        )
+
+        return [positions, self.slot_values[np.repeat(start, length) + offsets]]
+
+    def score_rows(self, rows: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """Spread score of the antibiotics in rows, given the occupancy counts of those rows"""
+        return spread_scores(self.in_range[rows], counts > 0)
+
+    def changed_rows(self, add=(), remove=()):
+        """Rows whose filled slots change, and their occupancy counts after the change"""
+        counts = self.counts.ravel().copy()
+        slots = []
+        for isolate in add:
+            np.add.at(counts, self.isolate_slots.get(isolate, []), 1)
+            slots.append(self.isolate_slots.get(isolate, []))
+        for isolate in remove:
+            np.subtract.at(counts, self.isolate_slots.get(isolate, []), 1)
+            slots.append(self.isolate_slots.get(isolate, []))
+        counts = counts.reshape(self.counts.shape)
+
+        if not slots:
+            return np.array([], dtype=int), counts
+        slots = np.unique(np.concatenate(slots)).astype(int)
+        flipped = (counts.ravel()[slots] > 0) != (self.counts.ravel()[slots] > 0)
+        rows = np.unique(slots[flipped] // N_SLOTS)
+
+        return rows, counts
+
+    def panel_score_after(self, add=(), remove=()) -> float:
+        """Whole panel score if the isolates in add were added and those in remove removed"""
+        rows, counts = self.changed_rows(add, remove)
+        if len(rows) == 0:
+            return self.panel_score()
+        scores = self.scores.copy()
+        scores[rows] = self.score_rows(rows, counts[rows])
+        return scores.mean()
+
+    def panel_scores_after_adding(self, candidates: list, remove=()) -> np.ndarray:
+        """
+        Whole panel score for each candidate if it was added to the panel,
+        after removing the isolates in remove. All candidates are scored in one go.
+        """
+        [_, counts] = self.changed_rows(remove=remove)
+        filled = counts > 0
+        scores = spread_scores(self.in_range, filled)
+
+        candidate_filled = np.zeros((len(candidates), filled.size), dtype=bool)
+        for c, isolate in enumerate(candidates):
+            candidate_filled[c, self.isolate_slots.get(isolate, [])] = True
+        candidate_filled = candidate_filled.reshape(len(candidates), *filled.shape)
+
+        # only antibiotics where a candidate fills an empty slot change score
+        changed = (candidate_filled & ~filled).any(axis=(0, 2))
+        candidate_scores = np.broadcast_to(
+            scores, (len(candidates), len(scores))
+        ).copy()
+        candidate_scores[:, changed] = spread_scores(
+            self.in_range[changed], candidate_filled[:, changed] | filled[changed]
+        )
+
+        return candidate_scores.mean(axis=1)
+
+    def update(self, add=(), remove=()) -> None:
+        """Add and remove isolates from the panel"""
+        rows, counts = self.changed_rows(add, remove)
+        self.counts = counts
+        if len(rows):
+            self.scores[rows] = self.score_rows(rows, counts[rows])
+        self.isolates.update(add)
+        self.isolates.difference_update(remove)
+
+    def add(self, isolate) -> None:
+        self.update(add=[isolate])
+
+    def remove(self, isolate) -> None:
+        self.update(remove=[isolate])
+
+    def panel_score(self) -> float:
+        """Mean score of all antibiotics, same as calc_whole_panel_score"""
+        return self.scores.mean()
+
+    def mic_spread_dict(self) -> dict:
+        """Scored mic_spread_dict of the panel, same format as calc_mic_spread_dict"""
+        valid = self.in_range | (self.counts > 0)
+        return {
+            antibiotic: (
+                [
+                    (1 if filled else 0) if is_valid else None
+                    for filled, is_valid in zip(self.counts[i] > 0, valid[i])
+                ],
+                float(self.scores[i]),
+            )
+            for i, antibiotic in enumerate(self.antibiotics)
+        }
@@ -1,18 +1,37 @@
 import pandas as pd
 import numpy as np
 import plotly.express as px
+import sys
+
+import project_paths
+
+project_paths.add_project_folders()
+from input_loading import load_visualisation_inputs
+from selection_output import read_selection_output, output_mic_frame
 from data_extraction_functions import (
     extract_chosen_isolates,
-    extract_mic_data,
-    extract_SIR,
-    filter_mic_values,
+    extract_mic_frame,
 )
 
+# Number of points above which plotly_dotplot switches to WebGL in "auto" mode
+WEBGL_POINTS = 5000
+
+# Long antibiotic names renamed for plotting purposes
+RENAME = {"Trimethoprim-sulfamethoxazole": "Trimeth-sulf"}
+
 
 def create_plot_df(
-    antibiotics: list, mic_data: list, x_jitter: float = 0.15, y_jitter: float = 0.05
+    antibiotics: list,
+    mic_frame: pd.DataFrame,
+    x_jitter: float = 0.15,
+    y_jitter: float = 0.05,
+    seed: int = 0,
 ) -> pd.DataFrame:
-    """Create dataframe used for plotting"""
+    """
+    Create dataframe used for plotting from the long frame of extract_mic_frame.
+    The jitter is drawn from a generator seeded with seed, so the same data gives
+    the same figure every run. seed=None gives a different layout every run.
+    """
 
     mic_dict = {
         "S": ("limegreen", "Sensitive"),
@@ -20,64 +39,82 @@ def create_plot_df(
         "R": ("tomato", "Resistant"),
     }
 
-    # Set ticks of x axis
-    x_axis = [i for i in range(len(antibiotics))]
-
-    # Initialize lists to hold values used for plotting
-    x_values, y_values = [], []
-    SIR_category_list = []
-    MIC_value_list = []
-    isolate_names = []
-    on_off_scale = []
-    pathogen_list = []
-
-    for x_value, abx_mic_data in zip(x_axis, mic_data):
-        for isolate, mic_value, SIR_category, scale, pathogen in abx_mic_data:
-            # Add random noise to avoid overlapping
-            x_value_jitter = x_value + np.random.uniform(-x_jitter, x_jitter)
-            mic_value_jitter = mic_value + np.random.uniform(-y_jitter, y_jitter)
-            # Add data to the lists
-            isolate_names.append(isolate)
-            x_values.append(x_value_jitter)
-            SIR_category_list.append(mic_dict[SIR_category][1])
-            MIC_value_list.append(2 ** (mic_value))
-            on_off_scale.append(scale)
-            pathogen_list.append(pathogen)
-            if scale is True:
-                y_values.append(mic_value_jitter)
-
-            # If off-scale move value to MAX_C or MIN_C
-            elif scale is False:
-                if SIR_category == "S":
-                    y_values.append(-10)
-                elif SIR_category == "R":
-                    y_values.append(11)
-                else:
-                    raise ValueError(
-                        f"SIR Category must be either S or R, not: {SIR_category}"
-                    )
-            else:
-                raise ValueError(
-                    f"scale must be Boolean value, not {type(scale)}. Current value: {scale}"
-                )
+    # Points in the order of the antibiotics, x axis tick = position of the antibiotic
+    x_axis = pd.Series(range(len(antibiotics)), index=antibiotics)
+    mic_frame = mic_frame[mic_frame["Antibiotic"].isin(antibiotics)]
+    x_value = mic_frame["Antibiotic"].map(x_axis).to_numpy()
+    mic_frame = mic_frame.iloc[np.argsort(x_value, kind="stable")]
+    x_value = np.sort(x_value, kind="stable")
+
+    SIR_category = mic_frame["SIR"].to_numpy()
+    scale = mic_frame["Scale"].to_numpy()
+    if scale.dtype != bool:
+        raise ValueError(f"scale must be Boolean value, not {scale.dtype}")
+
+    # Add random noise to avoid overlapping, all points in one draw
+    rng = np.random.default_rng(seed)
+    jitter = rng.uniform(-1, 1, size=(2, len(mic_frame)))
+    x_values = x_value + jitter[0] * x_jitter
+    y_values = mic_frame["Log2 MIC"].to_numpy() + jitter[1] * y_jitter
+
+    # If off-scale move value to MAX_C or MIN_C
+    off_scale_S = ~scale & (SIR_category == "S")
+    off_scale_R = ~scale & (SIR_category == "R")
+    invalid = ~scale & ~off_scale_S & ~off_scale_R
+    if invalid.any():
+        raise ValueError(
+            f"SIR Category must be either S or R, not: {SIR_category[invalid][0]}"
+        )
+    y_values[off_scale_S] = -10
+    y_values[off_scale_R] = 11
+
+    SIR_names = {k: name for k, (_, name) in mic_dict.items()}
+    SIR_category_list = mic_frame["SIR"].map(SIR_names)
+    if SIR_category_list.isna().any():
+        raise KeyError(SIR_category[SIR_category_list.isna().to_numpy()][0])
 
     # Create a DF used for plotting
     plot_df = pd.DataFrame(
         {
             "Antibiotics": x_values,
             "Log2(MIC-value)": y_values,
-            "Isolate names": isolate_names,
-            "SIR": SIR_category_list,
-            "Scale": on_off_scale,
-            "Pathogen": pathogen_list,
-            "MIC value": MIC_value_list,
+            "Isolate names": mic_frame["Isolate"].to_numpy(),
+            "SIR": SIR_category_list.to_numpy(),
+            "Scale": scale,
+            "Pathogen": mic_frame["Pathogen"].to_numpy(),
+            "MIC value": mic_frame["MIC"].to_numpy(),
         },
-        index=np.arange(len(x_values)),
+        index=np.arange(len(mic_frame)),
     )
 
     return plot_df
 
 
+def aggregate_plot_df(antibiotics: list, mic_frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Plot dataframe with one point per antibiotic, MIC value and SIR category.
+    The number of isolates in each point is in the Count column.
+    """
+    plot_df = create_plot_df(antibiotics, mic_frame, x_jitter=0, y_jitter=0)
+
+    aggregated_df = (
+        plot_df.groupby(["Antibiotics", "Log2(MIC-value)", "SIR"], sort=False)
+        .agg(
+            Count=("Isolate names", "size"),
+            Scale=("Scale", "first"),
+            Pathogen=("Pathogen", lambda p: ", ".join(sorted(set(p)))),
+            MIC=("MIC value", "first"),
+        )
+        .reset_index()
+        .rename(columns={"MIC": "MIC value"})
+    )
+    aggregated_df["Isolate names"] = aggregated_df["Count"].map(
+        lambda count: f"{count} isolates"
+    )
+
+    return aggregated_df
+
+
 def add_rectangles_to_plot(fig, antibiotics: list) -> None:
     names_to_conc = {
         "Benzylpenicillin": ["0.015 - 32.0", "0.008 - 16.0"],
@@ -162,7 +199,22 @@ def add_rectangles_to_plot(fig, antibiotics: list) -> None:
     )
 
 
-def plotly_dotplot(plot_df: pd.DataFrame, antibiotics: list) -> None:
+def plotly_dotplot(
+    plot_df: pd.DataFrame,
+    antibiotics: list,
+    render_mode: str = "auto",
+    output: str = "first_figure.html",
+    auto_open: bool = True,
+) -> None:
+    """
+    Dot plot of the plot dataframe, written to output. render_mode is "svg",
+    "webgl" or "auto" (webgl above WEBGL_POINTS points). A dataframe from
+    aggregate_plot_df is drawn with the marker size set by the Count column.
+    plotly.js is written once next to the html file instead of inlined.
+    """
+    if render_mode == "auto":
+        render_mode = "webgl" if len(plot_df) > WEBGL_POINTS else "svg"
+    aggregated = "Count" in plot_df.columns
 
     # Set ticks of x axis
     x_axis = [i for i in range(len(antibiotics))]
@@ -209,7 +261,10 @@ def plotly_dotplot(plot_df: pd.DataFrame, antibiotics: list) -> None:
             "Scale": False,
             "Pathogen": True,
             "MIC value": True,
+            **({"Count": True} if aggregated else {}),
         },
+        size="Count" if aggregated else None,
+        render_mode=render_mode,
     )
 
     # Changes the dot color depending on SIR category
@@ -239,20 +294,44 @@ def plotly_dotplot(plot_df: pd.DataFrame, antibiotics: list) -> None:
         legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
         title_x=0.5,
     )
-    fig.write_html("first_figure.html", auto_open=True)
+    fig.write_html(output, include_plotlyjs="directory", auto_open=auto_open)
     # fig.show()
 
 
-def main():
-    # Load files
-    chosen_isolates_list = pd.read_csv("Visualisation/Chosen_isolates_list.csv")
-    CIB = pd.ExcelFile("Visualisation/CIB_TF-data_AllIsolates_20230302.xlsx")
-    matrix_EU = pd.read_excel(CIB, "matrix EU")
+def plot(antibiotics: list, mic_frame: pd.DataFrame, mode: str = "auto"):
+    """Create dataframe used for plotting and plot it, mode as in main"""
+    if mode == "aggregated":
+        plot_df = aggregate_plot_df(antibiotics, mic_frame)
+        plotly_dotplot(plot_df, antibiotics)
+    else:
+        plot_df = create_plot_df(antibiotics, mic_frame)
+        plotly_dotplot(plot_df, antibiotics, render_mode=mode)
+
+
+def main(mode: str = "auto", selection_output: str = None):
+    """
+    mode: "svg", "webgl", "auto" or "aggregated" (one point per MIC value)
+    selection_output: folder of the binary selection output ("Binary output" in the
+    selection parameters), used instead of Chosen_isolates_list.csv and the CIB
+    """
+    CIB = "Visualisation/CIB_TF-data_AllIsolates_20230302.xlsx"
+
+    # Binary output of the selection, no need to read the CIB
+    if selection_output:
+        output = read_selection_output(selection_output)
+        antibiotics = [RENAME.get(a, a) for a in output["matrix EU antibiotics"]]
+        mic_frame = output_mic_frame(output)
+        mic_frame["Antibiotic"] = mic_frame["Antibiotic"].replace(RENAME)
+        plot(antibiotics, mic_frame, mode)
+        return
+
+    # Load files, concurrently
+    inputs = load_visualisation_inputs("Visualisation/Chosen_isolates_list.csv", CIB)
+    chosen_isolates_list = inputs["chosen isolates list"]
+    matrix_EU = inputs["matrix EU"]
 
     # Rename a long name for plotting purposes
-    matrix_EU.rename(
-        columns={"Trimethoprim-sulfamethoxazole": "Trimeth-sulf"}, inplace=True
-    )
+    matrix_EU.rename(columns=RENAME, inplace=True)
 
     # Select isolates
     chosen_isolates = extract_chosen_isolates(chosen_isolates_list, matrix_EU)
@@ -260,20 +339,12 @@ def main():
     # List of antiiotic names
     antibiotics = list(chosen_isolates.columns[3:])
 
-    # Extract all SIRs for an antibiotic.
-    chosen_isolates_SIR = extract_SIR(chosen_isolates, antibiotics)
-
-    # Remove the tuples that have None in their SIR data
-    filtered_chosen_isolates_SIR = filter_mic_values(chosen_isolates_SIR)
-
-    # Extract the mic-values of each isolate for each antibiotic.
-    mic_data = extract_mic_data(filtered_chosen_isolates_SIR, antibiotics)
-
-    # Create dataframe used for plotting
-    plot_df = create_plot_df(antibiotics, mic_data)
+    # All valid MIC values of the chosen isolates, one row per isolate and antibiotic
+    mic_frame = extract_mic_frame(chosen_isolates, antibiotics)
 
-    plotly_dotplot(plot_df, antibiotics)
+    plot(antibiotics, mic_frame, mode)
 
 
 if __name__ == "__main__":
-    main()
+    # Usage: python plotly_testpanel_vis.py [mode] [selection output folder]
+    main(*sys.argv[1:3])
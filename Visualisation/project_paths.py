@@ -0,0 +1,16 @@
+# Import paths of the project, set up by project_paths.py in the isolate selection folder
+
+import os
+import runpy
+
+PATHS_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "Isolate Selection Student Project",
+    "project_paths.py",
+)
+
+
+def add_project_folders():
+    """Put both project folders on sys.path"""
+    runpy.run_path(PATHS_FILE)["add_project_folders"]()
@@ -1,15 +1,47 @@
 import pandas as pd
 import json
+import sys
+
+import project_paths
+
+project_paths.add_project_folders()
+from input_loading import load_visualisation_inputs
+from selection_output import read_selection_output, output_mic_frame
 from data_extraction_functions import (
     extract_chosen_isolates,
-    extract_SIR,
-    filter_mic_values,
+    extract_mic_frame,
 )
 from spread_list_functions import (
     score_mic_spread_list,
     fill_mic_spread_list,
 )
 
+# Concentration grid of the spread lists, index 0 = Min C and index 21 = Max C
+total_concentration_range = [
+    "Min C",
+    "0.00195",
+    "0.00391",
+    "0.00781",
+    "0.01563",
+    "0.03125",
+    "0.0625",
+    "0.125",
+    "0.25",
+    "0.5",
+    "1.0",
+    "2.0",
+    "4.0",
+    "8.0",
+    "16.0",
+    "32.0",
+    "64.0",
+    "128.0",
+    "256.0",
+    "512.0",
+    "1024.0",
+    "Max C",
+]
+
 
 def create_mic_spread_dict(
     antibiotic_ranges: dict,
@@ -22,7 +54,7 @@ def create_mic_spread_dict(
         antibiotic: [0 for _ in range(len(total_concentration_range))]
         for antibiotic in antibiotic_ranges
     }
-    
+
     # Borde kunna förbättras. Kanske combinera värdena till en tuple i samma dict.
     # Blir kanske lite otydligare variabelnamn dock.
     for (_, ranges), (_, mic_spread) in zip(
@@ -68,61 +100,73 @@ def fill_mic_spread_dict(
     return mic_spread_dict
 
 
+def fill_mic_spread_dict_from_frame(
+    antibiotics: list,
+    mic_frame: pd.DataFrame,
+    mic_spread_dict: dict,
+) -> dict:
+    """Same as fill_mic_spread_dict, from the long frame of extract_mic_frame"""
+    unique_mic_values = mic_frame.groupby("Antibiotic", sort=False)["MIC"].unique()
+
+    for antibiotic in antibiotics:
+        mic_spread_list = mic_spread_dict[antibiotic]
+        if antibiotic in unique_mic_values.index:
+            fill_mic_spread_list(mic_spread_list, sorted(unique_mic_values[antibiotic]))
+    return mic_spread_dict
+
+
 def score_mic_spread_dict(mic_spread_dict: dict):
     for antibiotic, spread_list in mic_spread_dict.items():
         mic_spread_dict[antibiotic] = (spread_list, score_mic_spread_list(spread_list))
 
 
-def score_whole_panel(mic_spread_dict: dict) -> int:
-    whole_panel_score = 0
+def calc_whole_panel_score(mic_spread_dict: dict) -> float:
+    """Mean score of all antibiotics in a scored mic_spread_dict"""
+    return sum(score for _, score in mic_spread_dict.values()) / len(mic_spread_dict)
+
+
+def score_whole_panel(mic_spread_dict: dict) -> float:
     print(f"{'Antibiotic':<30}|{'Score':<7}| Valid spread list")
     for abx, (spread_list, score) in mic_spread_dict.items():
         valid_spread_list = [i for i in spread_list if i is not None]
         print(f"{abx:29} | {round(score, 2):<5} | {valid_spread_list}  ")
         # print(f"{abx:<10}: {valid_spread_list} | score: {score:.2f}")
-        whole_panel_score += score
 
-    whole_panel_score /= len(mic_spread_dict)
+    whole_panel_score = calc_whole_panel_score(mic_spread_dict)
     print(f"\nWhole panel score: {whole_panel_score:.2f}")
+    return whole_panel_score
 
 
-def main():
-    # Load files
-    chosen_isolates_list = pd.read_csv("Visualisation/Chosen_isolates_list.csv")
-    CIB = pd.ExcelFile("Visualisation/CIB_TF-data_AllIsolates_20230302.xlsx")
-    matrix_EU = pd.read_excel(CIB, "matrix EU")
-    antibiotics_ranges = json.load(open("Visualisation/abx_ranges.json"))
+def calc_mic_spread_dict(
+    chosen_isolates_list: pd.DataFrame,
+    matrix_EU: pd.DataFrame,
+    antibiotics_ranges: dict,
+) -> dict:
+    """
+    Fill and score the spread lists of the chosen isolates. Returns a dictionary
+    with antibiotics as keys and (spread list, score) as value.
+    """
+    # Select isolates
+    chosen_isolates = extract_chosen_isolates(chosen_isolates_list, matrix_EU)
 
-    # Rename a long name for plotting purposes
-    # matrix_EU.rename(
-    #     columns={"Trimethoprim-sulfamethoxazole": "Trimeth-sulf"}, inplace=True
-    # )
+    # List of antibiotic names
+    antibiotics = list(chosen_isolates.columns[3:])
 
-    total_concentration_range = [
-        "Min C",
-        "0.00195",
-        "0.00391",
-        "0.00781",
-        "0.01563",
-        "0.03125",
-        "0.0625",
-        "0.125",
-        "0.25",
-        "0.5",
-        "1.0",
-        "2.0",
-        "4.0",
-        "8.0",
-        "16.0",
-        "32.0",
-        "64.0",
-        "128.0",
-        "256.0",
-        "512.0",
-        "1024.0",
-        "Max C",
-    ]
+    # All valid MIC values of the chosen isolates, one row per isolate and antibiotic
+    mic_frame = extract_mic_frame(chosen_isolates, antibiotics)
 
+    return calc_mic_spread_dict_from_frame(antibiotics, mic_frame, antibiotics_ranges)
+
+
+def calc_mic_spread_dict_from_frame(
+    antibiotics: list,
+    mic_frame: pd.DataFrame,
+    antibiotics_ranges: dict,
+) -> dict:
+    """
+    Same as calc_mic_spread_dict, from the long frame of extract_mic_frame
+    (e.g. the mic frame of the binary selection output).
+    """
     # Dictionary to go between concentration and indices
     concentration_to_index_convert = {
         concentration: index
@@ -133,28 +177,58 @@ def main():
         antibiotics_ranges, total_concentration_range, concentration_to_index_convert
     )
 
-    # Select isolates
-    chosen_isolates = extract_chosen_isolates(chosen_isolates_list, matrix_EU)
+    mic_spread_dict = fill_mic_spread_dict_from_frame(
+        antibiotics,
+        mic_frame,
+        mic_spread_dict,
+    )
 
-    # List of antibiotic names
-    antibiotics = list(chosen_isolates.columns[3:])
+    score_mic_spread_dict(mic_spread_dict)
 
-    # Extract all SIRs for an antibiotic.
-    chosen_isolates_SIR = extract_SIR(chosen_isolates, antibiotics)
+    return mic_spread_dict
 
-    # Remove the tuples that have None in their SIR data
-    filtered_chosen_isolates_SIR = filter_mic_values(chosen_isolates_SIR)
 
-    mic_spread_dict = fill_mic_spread_dict(
-        antibiotics,
-        filtered_chosen_isolates_SIR,
-        mic_spread_dict,
+def main(selection_output: str = None):
+    """
+    selection_output: folder of the binary selection output ("Binary output" in the
+    selection parameters), used instead of Chosen_isolates_list.csv and the CIB
+    """
+    CIB = "Visualisation/CIB_TF-data_AllIsolates_20230302.xlsx"
+
+    # Binary output of the selection, no need to read the CIB
+    if selection_output:
+        output = read_selection_output(selection_output)
+        antibiotics_ranges = json.load(open("Visualisation/abx_ranges.json"))
+        mic_spread_dict = calc_mic_spread_dict_from_frame(
+            output["matrix EU antibiotics"],
+            output_mic_frame(output),
+            antibiotics_ranges,
+        )
+        score_whole_panel(mic_spread_dict)
+        return
+
+    # Load files, concurrently
+    inputs = load_visualisation_inputs(
+        "Visualisation/Chosen_isolates_list.csv",
+        CIB,
+        "Visualisation/abx_ranges.json",
     )
+    chosen_isolates_list = inputs["chosen isolates list"]
+    matrix_EU = inputs["matrix EU"]
+    antibiotics_ranges = inputs["abx ranges"]
 
-    score_mic_spread_dict(mic_spread_dict)
+    # Rename a long name for plotting purposes
+    # matrix_EU.rename(
+    #     columns={"Trimethoprim-sulfamethoxazole": "Trimeth-sulf"}, inplace=True
+    # )
+
+    mic_spread_dict = calc_mic_spread_dict(
+        chosen_isolates_list, matrix_EU, antibiotics_ranges
+    )
 
     score_whole_panel(mic_spread_dict)
 
 
 if __name__ == "__main__":
-    main()
+    # Usage: python spread_score_calc.py [selection output folder]
+    main(*sys.argv[1:2])